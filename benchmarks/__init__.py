@@ -0,0 +1 @@
+"""Benchmarks for imagesorter, see run.py"""
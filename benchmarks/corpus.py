@@ -0,0 +1,325 @@
+'''
+Synthetic media files for the benchmarks.
+
+Everything is built from scratch with struct, so the corpus is the same
+byte for byte on every machine and no sample photos have to be shipped.
+The files are small but shaped like what cameras write: an EXIF date in a
+sub IFD, GPS data, a thumbnail IFD, long strip offset arrays in the big
+variants, and a maker note in the layout each make uses.
+
+    python -m benchmarks.corpus /path/to/corpus [files per kind]
+'''
+import os
+import sys
+import struct
+import calendar
+import datetime
+
+
+# TIFF field types
+BYTE, ASCII, SHORT, LONG, RATIONAL, UNDEFINED, SLONG, SRATIONAL = \
+    1, 2, 3, 4, 5, 7, 9, 10
+
+_formats = {BYTE: 'B', SHORT: 'H', LONG: 'I', SLONG: 'i',
+            RATIONAL: 'II', SRATIONAL: 'ii'}
+
+# kind -> extension of the files of that kind
+kinds = [('jpeg', 'JPG'), ('jfif', 'jpg'), ('tiff_nikon', 'NEF'),
+         ('tiff_fujifilm', 'tif'), ('tiff_olympus', 'ORF'),
+         ('tiff_casio', 'tif'), ('cr2_canon', 'CR2'), ('avi', 'AVI'),
+         ('mov', 'MOV'), ('mp4', 'mp4')]
+image_kinds = [kind for kind, ext in kinds if kind not in
+               ('avi', 'mov', 'mp4')]
+video_kinds = ['avi', 'mov', 'mp4']
+
+_makes = {'jpeg': 'Canon', 'jfif': 'Acme', 'tiff_nikon': 'NIKON CORPORATION',
+          'tiff_fujifilm': 'FUJIFILM', 'tiff_olympus': 'OLYMPUS IMAGING CORP.',
+          'tiff_casio': 'CASIO COMPUTER CO.,LTD.', 'cr2_canon': 'Canon'}
+
+# seconds from 1904-01-01, where QuickTime counts from, to 1970-01-01
+_mac_epoch = 2082844800
+
+
+def _pack(e, typ, value):
+    if typ in (ASCII, UNDEFINED):
+        return value
+    if typ in (RATIONAL, SRATIONAL):
+        return ''.join(struct.pack(e + _formats[typ], *v) for v in value)
+    return ''.join(struct.pack(e + _formats[typ], v) for v in value)
+
+
+def ifd(e, entries, at, base=0):
+    """Return an IFD written at offset at, followed by its values, with a
+    next IFD offset of 0.
+
+    entries are (tag, type, value). value is a string for ASCII and
+    UNDEFINED and a list of numbers, or pairs for rationals, otherwise.
+    It can also be a function, which is given the offset its data will be
+    at and returns that data: the entry then points to it, as a LONG for
+    sub IFDs and as a block of bytes for anything else. Offsets written
+    are relative to base.
+    """
+    entries = sorted(entries)
+    data_at = at + 2 + 12 * len(entries) + 4
+    table = [struct.pack(e + 'H', len(entries))]
+    data = []
+    size = 0
+    for tag, typ, value in entries:
+        pos = data_at + size
+        if callable(value):
+            raw = value(pos)
+            count = 1 if typ == LONG else len(raw)
+            field = struct.pack(e + 'I', pos - base)
+        else:
+            raw = _pack(e, typ, value)
+            if typ in (ASCII, UNDEFINED):
+                count = len(raw)
+            else:
+                count = len(value)
+            if len(raw) <= 4:
+                field = raw.ljust(4, '\0')
+                raw = ''
+            else:
+                field = struct.pack(e + 'I', pos - base)
+        table.append(struct.pack(e + 'HHI', tag, typ, count) + field)
+        if raw:
+            if len(raw) % 2:
+                raw = raw + '\0'
+            data.append(raw)
+            size = size + len(raw)
+    table.append(struct.pack(e + 'I', 0))
+    return ''.join(table) + ''.join(data)
+
+
+def _makernote_entries(make, big):
+    if make == 'Canon':
+        # camera settings and shot info, which EXIF.py decodes further
+        return [(0x0001, SHORT, range(1, 40)), (0x0004, SHORT, range(0, 30)),
+                (0x0006, ASCII, 'Canon EOS\0')]
+    n = 40 if big else 6
+    entries = [(0x0100 + i, LONG if i % 2 else SHORT, [i * 7] * (1 + i % 3))
+               for i in range(n)]
+    entries.append((0x0200, RATIONAL, [(3, 2), (5, 7)]))
+    entries.append((0x0201, UNDEFINED, 'x' * (2000 if big else 10)))
+    return entries
+
+
+def _makernote(e, make, big):
+    entries = _makernote_entries(make, big)
+
+    def note(pos):
+        if make.startswith('NIKON'):
+            # type 2: a label, then a TIFF header offsets are relative to
+            header = (('II*\0' if e == '<' else 'MM\0*') +
+                      struct.pack(e + 'I', 8))
+            return ('Nikon\0\x02\x10\0\0' + header +
+                    ifd(e, entries, pos + 18, pos + 10))
+        if make == 'FUJIFILM':
+            # always little endian, offsets relative to the note
+            return 'FUJIFILM' + struct.pack('<I', 12) + ifd('<', entries, 12)
+        if make.startswith('OLYMPUS'):
+            return 'OLYMP\0\x01\0' + ifd(e, entries, pos + 8)
+        return ifd(e, entries, pos)
+    return note
+
+
+def _exif_date(when):
+    return when.strftime('%Y:%m:%d %H:%M:%S') + '\0'
+
+
+def tiff(e, make, when, big=False, cr2=False):
+    """Return a TIFF file with the EXIF, GPS, maker note and thumbnail of a
+    camera of make, taken at when. cr2 gives it the header of a Canon raw
+    file."""
+    date = _exif_date(when)
+    exif = [(0x829A, RATIONAL, [(1, 250)]), (0x829D, RATIONAL, [(28, 10)]),
+            (0x9003, ASCII, date), (0x9004, ASCII, date),
+            (0x9201, SRATIONAL, [(-5, 3)]), (0x9204, SRATIONAL, [(-1, 3)]),
+            (0xA002, LONG, [4000]), (0xA003, LONG, [3000]),
+            (0x9286, UNDEFINED, 'ASCII\0\0\0hello world'),
+            (0x927C, UNDEFINED, _makernote(e, make, big))]
+    gps = [(0x0001, ASCII, 'N\0'),
+           (0x0002, RATIONAL, [(40, 1), (44, 1), (1234, 100)])]
+    strips = 300 if big else 3
+    ifd0 = [(0x010F, ASCII, make + '\0'), (0x0110, ASCII, 'Model X\0'),
+            (0x0112, SHORT, [1]), (0x011A, RATIONAL, [(72, 1)]),
+            (0x0132, ASCII, date),
+            (0x8769, LONG, lambda pos: ifd(e, exif, pos)),
+            (0x8825, LONG, lambda pos: ifd(e, gps, pos)),
+            (0x0111, LONG, range(100, 100 + strips)),
+            (0x0117, LONG, [10] * strips)]
+    thumbnail = '\xFF\xD8\xFF\xD9'
+    ifd1 = [(0x0103, SHORT, [6]),
+            (0x0201, LONG, lambda pos: thumbnail),
+            (0x0202, LONG, [len(thumbnail)])]
+    if cr2:
+        header = ('II' if e == '<' else 'MM') + struct.pack(e + 'HI', 42, 16)
+        header = header + 'CR\x02\x00' + struct.pack(e + 'I', 0)
+    else:
+        header = ('II' if e == '<' else 'MM') + struct.pack(e + 'HI', 42, 8)
+    first = ifd(e, ifd0, len(header))
+    # chain the thumbnail IFD after the first one
+    next_at = len(header) + 2 + 12 * len(ifd0)
+    second_at = len(header) + len(first)
+    first = (first[:next_at - len(header)] +
+             struct.pack(e + 'I', second_at) +
+             first[next_at - len(header) + 4:])
+    return header + first + ifd(e, ifd1, second_at)
+
+
+def jpeg(tiff_data, jfif=False):
+    """Return a JPEG with tiff_data as its EXIF segment, after a JFIF
+    segment if jfif is set"""
+    out = ['\xFF\xD8']
+    if jfif:
+        app0 = 'JFIF\0\x01\x01\0\0\x01\0\x01\0\0'
+        out.append('\xFF\xE0' + struct.pack('>H', len(app0) + 2) + app0)
+    app1 = 'Exif\0\0' + tiff_data
+    out.append('\xFF\xE1' + struct.pack('>H', len(app1) + 2) + app1)
+    # a token quantisation table and scan, so the file looks like a photo
+    dqt = '\0' + ''.join(chr(i) for i in range(1, 65))
+    out.append('\xFF\xDB' + struct.pack('>H', len(dqt) + 2) + dqt)
+    out.append('\xFF\xDA' + struct.pack('>H', 8) + '\x01\x01\0\0\x3F\0')
+    out.append('\x55' * 512 + '\xFF\xD9')
+    return ''.join(out)
+
+
+def _chunk(fourcc, data):
+    # the size leaves out the pad byte that keeps chunks word aligned
+    return (fourcc + struct.pack('<I', len(data)) + data +
+            '\0' * (len(data) % 2))
+
+
+def _riff_list(kind, chunks):
+    return _chunk('LIST', kind + ''.join(chunks))
+
+
+def avi(when, frames=10):
+    """Return a RIFF AVI as a camera writes it, with the date both in an
+    IDIT chunk and in the ICRD of the INFO list"""
+    avih = struct.pack('<14I', 33333, 1000000, 0, 0x10, frames, 0, 1, 65536,
+                       320, 240, 0, 0, 0, 0)
+    strh = ('vids' + 'MJPG' + struct.pack('<IHHIIIIIIIIhhhh', 0, 0, 0, 0, 1,
+                                          30, 0, frames, 65536, 0xFFFFFFFF,
+                                          0, 0, 0, 320, 240))
+    strf = struct.pack('<IiiHH4sIiiII', 40, 320, 240, 1, 24, 'MJPG',
+                       320 * 240 * 3, 0, 0, 0, 0)
+    idit = when.strftime('%a %b %d %H:%M:%S %Y') + '\n\0'
+    hdrl = _riff_list('hdrl', [_chunk('avih', avih),
+                               _riff_list('strl', [_chunk('strh', strh),
+                                                   _chunk('strf', strf)]),
+                               _chunk('IDIT', idit)])
+    info = _riff_list('INFO', [_chunk('ICRD', when.strftime('%Y-%m-%d') +
+                                      '\0'),
+                               _chunk('ISFT', 'Camera firmware 1.0\0')])
+    frame = '\xFF\xD8' + '\x55' * 1000 + '\xFF\xD9'
+    movi = _riff_list('movi', [_chunk('00dc', frame)] * frames)
+    idx1 = _chunk('idx1', ''.join(struct.pack('<4sIII', '00dc', 0x10,
+                                              4 + i * (len(frame) + 8),
+                                              len(frame))
+                                  for i in range(frames)))
+    body = 'AVI ' + hdrl + info + movi + idx1
+    return 'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def _atom(kind, data):
+    return struct.pack('>I', len(data) + 8) + kind + data
+
+
+def _mvhd(when):
+    seconds = calendar.timegm(when.timetuple()) + _mac_epoch
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0,
+                         0x40000000)
+    return _atom('mvhd', struct.pack('>B3sIIII', 0, '\0\0\0', seconds,
+                                     seconds, 600, 6000) +
+                 struct.pack('>IH10s', 0x10000, 0x100, '\0' * 10) +
+                 matrix + '\0' * 24 + struct.pack('>I', 2))
+
+
+def _apple_creationdate(when):
+    """moov/meta with the com.apple.quicktime.creationdate key iPhones
+    write, which carries the time zone"""
+    key = 'com.apple.quicktime.creationdate'
+    hdlr = _atom('hdlr', '\0' * 8 + 'mdta' + '\0' * 13)
+    keys = _atom('keys', '\0' * 4 + struct.pack('>I', 1) +
+                 struct.pack('>I', len(key) + 8) + 'mdta' + key)
+    value = when.strftime('%Y-%m-%dT%H:%M:%S') + '+0200'
+    data = _atom('data', struct.pack('>II', 1, 0) + value)
+    ilst = _atom('ilst', struct.pack('>I', len(data) + 8) +
+                 struct.pack('>I', 1) + data)
+    return _atom('meta', hdlr + keys + ilst)
+
+
+def quicktime(when, brand, mdat_first=False, apple=False):
+    """Return a QuickTime/MP4 file with the date in its mvhd, and in the
+    Apple metadata too if apple is set. Cameras write the mdat first, so
+    the moov has to be looked for past it."""
+    ftyp = _atom('ftyp', brand + '\0\0\0\0' + brand + 'mp41')
+    tkhd = _atom('tkhd', '\0\0\0\x03' + '\0' * 80)
+    trak = _atom('trak', tkhd + _atom('mdia', _atom('mdhd', '\0' * 24)))
+    moov_data = _mvhd(when) + trak
+    if apple:
+        moov_data = moov_data + _apple_creationdate(when)
+    moov = _atom('moov', moov_data)
+    mdat = _atom('mdat', '\x55' * 4096)
+    if mdat_first:
+        return ftyp + mdat + moov
+    return ftyp + moov + mdat
+
+
+def when_for(i):
+    """The date file i of a kind is taken at"""
+    return (datetime.datetime(2012, 1, 1, 8, 0, 0) +
+            datetime.timedelta(days=i * 7 % 366, seconds=i * 3607 % 86400))
+
+
+def make_file(kind, i):
+    """Return the content of file i of kind, and of its sidecar or None"""
+    when = when_for(i)
+    e = '<' if i % 2 else '>'
+    big = i % 4 == 3
+    if kind in ('jpeg', 'jfif'):
+        return jpeg(tiff(e, _makes[kind], when, big), kind == 'jfif'), None
+    if kind == 'cr2_canon':
+        return tiff('<', _makes[kind], when, big, cr2=True), None
+    if kind.startswith('tiff_'):
+        return tiff(e, _makes[kind], when, big), None
+    if kind == 'avi':
+        return avi(when), jpeg(tiff('<', 'Canon', when))
+    if kind == 'mov':
+        return quicktime(when, 'qt  ', apple=bool(i % 2)), None
+    if kind == 'mp4':
+        return quicktime(when, 'isom', mdat_first=True), None
+    raise ValueError('unknown kind ' + kind)
+
+
+def generate(root, count=20):
+    """Write count files of every kind under root/<kind>/. Returns
+    {kind: [paths]}, AVI files without their THM sidecars."""
+    files = {}
+    for kind, ext in kinds:
+        dirname = os.path.join(root, kind)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        files[kind] = []
+        for i in range(count):
+            name = 'IMG_%04d.%s' % (i, ext)
+            if kind in video_kinds:
+                name = 'MVI_%04d.%s' % (i, ext)
+            path = os.path.join(dirname, name)
+            data, sidecar = make_file(kind, i)
+            with open(path, 'wb') as f:
+                f.write(data)
+            if sidecar is not None:
+                thm = os.path.splitext(path)[0] + '.THM'
+                with open(thm, 'wb') as f:
+                    f.write(sidecar)
+            files[kind].append(path)
+    return files
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(2)
+    generate(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -0,0 +1,242 @@
+'''
+Micro-benchmarks for the metadata parsers and directory formatting.
+
+Generates the synthetic corpus of corpus.py, times every parser on every
+kind of file it would be given, and writes the time per call to JSON. Given
+a baseline, an earlier output of this script, it compares against it and
+exits with status 1 if anything got slower by more than the threshold.
+
+    python -m benchmarks.run [-c corpus] [-o results.json] [-b baseline.json]
+                             [-n files per kind] [-r repeat] [-t threshold]
+
+    -c --corpus     Directory to generate the corpus in. Default is a
+                    temporary directory, removed afterwards.
+    -o --output     File to write the results to as JSON.
+    -b --baseline   Results to compare against.
+    -n --files      Files of every kind in the corpus. Default is 20.
+    -r --repeat     How often every timing is taken, the fastest counts.
+                    Default is 5.
+    -t --threshold  How much slower than the baseline, in percent, counts as
+                    a regression. Default is 10.
+
+Run it from the top of the source tree, with hachoir and PIL installed.
+'''
+import os
+import sys
+import json
+import getopt
+import logging
+import platform
+import tempfile
+import shutil
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src', 'imagesorter'))
+import EXIF
+import backends
+import imagesorter
+from benchmarks import corpus
+
+
+_dir_formats = ['yyyy/mmmm/yyyy_mm_dd', 'yyyy/yyyy_mm_dd', 'yy/mmm/dddd d']
+_all_kinds = [kind for kind, ext in corpus.kinds]
+
+
+def _process_file(path):
+    with open(path, 'rb') as f:
+        return EXIF.process_file(f)
+
+
+def _process_file_dates(path):
+    with open(path, 'rb') as f:
+        return EXIF.process_file(f, want=imagesorter._date_tags)
+
+
+def _opened(read):
+    """Return a function of a path calling read, a metadata backend, with
+    the path and the file opened"""
+    def read_file(path):
+        with open(path, 'rb') as f:
+            return read(path, backends.PrefixedFile(f))
+    return read_file
+
+
+def _paths(kind, files):
+    return [(path,) for path in files[kind]]
+
+
+def _exif_data(kind, files):
+    return [(imagesorter.get_exif_data(path),) for path in files[kind]]
+
+
+def _dir_format_dates(format, files):
+    return [(format, corpus.when_for(i), '/target') for i in range(366)]
+
+
+# (name, function, kinds, function returning the argument tuples of the
+# calls to time for a kind)
+benchmarks = [
+    ('EXIF.process_file', _process_file, corpus.image_kinds, _paths),
+    ('EXIF.process_file(want)', _process_file_dates, corpus.image_kinds,
+     _paths),
+    ('get_pil_exif_data', imagesorter.get_pil_exif_data, corpus.image_kinds,
+     _paths),
+    ('read_quicktime_date', _opened(imagesorter.read_quicktime_date),
+     ['mov', 'mp4'], _paths),
+    ('read_riff_date', _opened(imagesorter.read_riff_date), ['avi'], _paths),
+    ('get_hachoir_create_date', imagesorter.get_hachoir_create_date,
+     corpus.video_kinds, _paths),
+    ('get_create_date', imagesorter.get_create_date, corpus.image_kinds,
+     _exif_data),
+    ('read_create_date', imagesorter.read_create_date, _all_kinds, _paths),
+    ('get_file_create_date', imagesorter.get_file_create_date, _all_kinds,
+     _paths),
+    ('createdirpath', imagesorter.createdirpath, _dir_formats,
+     _dir_format_dates),
+]
+
+
+def measure(func, calls, repeat):
+    """Return the fastest time per call of calling func with every argument
+    tuple of calls, out of repeat runs"""
+    best = None
+    for i in xrange(repeat):
+        start = timeit.default_timer()
+        for args in calls:
+            func(*args)
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(calls)
+
+
+def run(files, repeat):
+    """Time every benchmark on files, as returned by corpus.generate().
+    Returns {name: {kind: seconds per call}}, None where the function
+    raised."""
+    timings = {}
+    for name, func, kinds, make_calls in benchmarks:
+        timings[name] = {}
+        for kind in kinds:
+            calls = make_calls(kind, files)
+            try:
+                # warms up caches, and finds out if it works at all
+                for args in calls:
+                    func(*args)
+            except Exception, err:
+                print >>sys.stderr, name, kind, "failed:", err
+                timings[name][kind] = None
+                continue
+            timings[name][kind] = measure(func, calls, repeat)
+    return timings
+
+
+def compare(timings, baseline, threshold):
+    """Return a report of timings against baseline, and the number of
+    regressions: timings more than threshold (a fraction) slower"""
+    lines = []
+    regressions = 0
+    for name, func, kinds, make_calls in benchmarks:
+        for kind in kinds:
+            now = timings.get(name, {}).get(kind)
+            before = baseline.get(name, {}).get(kind)
+            if not now or not before:
+                continue
+            ratio = now / before
+            note = ""
+            if ratio > 1 + threshold:
+                note = "REGRESSION"
+                regressions = regressions + 1
+            elif ratio < 1 - threshold:
+                note = "faster"
+            lines.append("%-26s %-22s %10.1f us %10.1f us %6.2fx %s" %
+                         (name, kind, before * 1e6, now * 1e6, ratio, note))
+    return lines, regressions
+
+
+def report(timings):
+    lines = []
+    for name, func, kinds, make_calls in benchmarks:
+        for kind in kinds:
+            seconds = timings[name][kind]
+            if seconds is None:
+                lines.append("%-26s %-22s %13s" % (name, kind, "failed"))
+            else:
+                lines.append("%-26s %-22s %10.1f us" %
+                             (name, kind, seconds * 1e6))
+    return lines
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hc:o:b:n:r:t:",
+                                   ["help", "corpus=", "output=",
+                                    "baseline=", "files=", "repeat=",
+                                    "threshold="])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(2)
+
+    corpus_dir = None
+    output = None
+    baseline = None
+    count = 20
+    repeat = 5
+    threshold = 10.0
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print __doc__
+            sys.exit()
+        elif o in ("-c", "--corpus"):
+            corpus_dir = a
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-b", "--baseline"):
+            baseline = a
+        elif o in ("-n", "--files"):
+            count = int(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-t", "--threshold"):
+            threshold = float(a)
+
+    # the parsers log every file they can't make sense of
+    logging.disable(logging.CRITICAL)
+    temporary = corpus_dir is None
+    if temporary:
+        corpus_dir = tempfile.mkdtemp(prefix='imagesorter-bench-')
+    try:
+        files = corpus.generate(corpus_dir, count)
+        timings = run(files, repeat)
+    finally:
+        if temporary:
+            shutil.rmtree(corpus_dir)
+
+    results = {'meta': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'files': count,
+                        'repeat': repeat},
+               'timings': timings}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if not baseline:
+        print "\n".join(report(timings))
+        return 0
+    with open(baseline) as f:
+        before = json.load(f)['timings']
+    lines, regressions = compare(timings, before, threshold / 100)
+    print "%-26s %-22s %13s %13s %7s" % ("benchmark", "kind", "baseline",
+                                        "now", "ratio")
+    print "\n".join(lines)
+    if regressions:
+        print str(regressions) + " regressions over " + str(threshold) + "%"
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -20,7 +20,16 @@
 #
 # where TAG is a valid tag name, ex 'DateTimeOriginal'
 #
-# These 2 are useful when you are retrieving a large list of images
+# To only retrieve some tags, pass the -w KEY or --want KEY argument
+# (repeat it for more tags), or as
+#    tags = EXIF.process_file(f, want=['EXIF DateTimeOriginal'])
+#
+# where KEY is a dictionary key as described below.  Only the IFDs
+# holding those tags are read, processing stops as soon as they are all
+# found, and thumbnails and MakerNotes are skipped.  Tags in the Image,
+# Thumbnail, EXIF, EXIF Interoperability and GPS IFDs can be wanted.
+#
+# These 3 are useful when you are retrieving a large list of images
 #
 #
 # To return an error on invalid tags,
@@ -83,6 +92,21 @@
 #
 
 
+import struct
+
+# how much of a TIFF file to read up front, the buffer grows on demand
+TIFF_PREFIX = 128 * 1024
+# reads further than this past the buffer get a window of this size of
+# their own, instead of growing the buffer over the gap
+TIFF_WINDOW = 4096
+
+# struct formats for s2n by (endian, length, signed)
+S2N_FORMATS = {}
+for _endian, _bo in (('I', '<'), ('M', '>')):
+    for _length, _fmt in ((1, 'b'), (2, 'h'), (4, 'i'), (8, 'q')):
+        S2N_FORMATS[(_endian, _length, 1)] = _bo + _fmt
+        S2N_FORMATS[(_endian, _length, 0)] = _bo + _fmt.upper()
+
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
     str = ''
@@ -1207,7 +1231,9 @@ def gcd(a, b):
     else:
         return gcd(b, a % b)
 
-class Ratio:
+class Ratio(object):
+    __slots__ = ('num', 'den')
+
     def __init__(self, num, den):
         self.num = num
         self.den = den
@@ -1225,11 +1251,16 @@ class Ratio:
             self.den = self.den / div
 
 # for ease of dealing with tags
-class IFD_Tag:
+# There can be millions of these when sorting a big archive, so they use
+# __slots__ and the printable version is only computed on first access.
+class IFD_Tag(object):
+    __slots__ = ('_printable', 'tag', 'field_type', 'field_offset',
+                 'field_length', 'values', 'tag_entry')
+
     def __init__(self, printable, tag, field_type, values, field_offset,
-                 field_length):
-        # printable version of data
-        self.printable = printable
+                 field_length, tag_entry=None):
+        # printable version of data, None to make it from values when needed
+        self._printable = printable
         # tag ID number
         self.tag = tag
         # field type as index into FIELD_TYPES
@@ -1240,6 +1271,43 @@ class IFD_Tag:
         self.field_length = field_length
         # either a string or array of data items
         self.values = values
+        # entry from the tag dictionary, used to make the printable version
+        self.tag_entry = tag_entry
+
+    def _get_printable(self):
+        if self._printable is None:
+            self._printable = self.make_printable()
+        return self._printable
+
+    def _set_printable(self, printable):
+        self._printable = printable
+
+    printable = property(_get_printable, _set_printable)
+
+    # compute printable version of values
+    def make_printable(self):
+        values = self.values
+        count = self.field_length // FIELD_TYPES[self.field_type][0]
+        if count == 1 and self.field_type != 2:
+            printable=str(values[0])
+        elif count > 50 and len(values) > 20 :
+            printable=str( values[0:20] )[0:-1] + ", ... ]"
+        else:
+            printable=str(values)
+
+        tag_entry = self.tag_entry
+        if tag_entry:
+            if len(tag_entry) != 1:
+                # optional 2nd tag element is present
+                if callable(tag_entry[1]):
+                    # call mapping function
+                    printable = tag_entry[1](values)
+                else:
+                    printable = ''
+                    for i in values:
+                        # use lookup table for this tag
+                        printable += tag_entry[1].get(i, repr(i))
+        return printable
 
     def __str__(self):
         return self.printable
@@ -1251,8 +1319,15 @@ class IFD_Tag:
                                         self.field_offset)
 
 # class that handles an EXIF header
+# The header is decoded from an in-memory copy of the file that starts at
+# the TIFF header, instead of a seek and a tiny read for every integer.
+# 'size' is how much to read up front (for a JPEG the whole APP1 segment);
+# anything beyond it is read on demand, by growing the buffer when it is
+# close to its end and into a separate window when it is further away, like
+# the IFDs libtiff writes after the image data.
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
+    def __init__(self, file, endian, offset, fake_exif, strict, debug=0,
+                 size=TIFF_PREFIX):
         self.file = file
         self.endian = endian
         self.offset = offset
@@ -1260,14 +1335,65 @@ class EXIF_header:
         self.strict = strict
         self.debug = debug
         self.tags = {}
+        # self.data holds the file from absolute position self.base onwards
+        self.base = offset
+        self.file.seek(offset)
+        self.data = self.file.read(size)
+        self.eof = len(self.data) < size
+        # (absolute position, bytes) read far past the buffer
+        self.windows = []
+
+    # make sure the buffer covers absolute position end, if the file does
+    def _extend(self, end):
+        if self.eof:
+            return
+        have = self.base + len(self.data)
+        # at least double, so growing through a big file stays linear
+        want = max(end - have, len(self.data))
+        self.file.seek(have)
+        more = self.file.read(want)
+        self.eof = len(more) < want
+        self.data += more
+
+    # read length bytes at absolute position pos from a window
+    def _window(self, pos, length):
+        for start, data in self.windows:
+            if start <= pos and pos + length <= start + len(data):
+                return data[pos - start:pos - start + length]
+        self.file.seek(pos)
+        data = self.file.read(max(length, TIFF_WINDOW))
+        self.windows.append((pos, data))
+        return data[:length]
+
+    # read length bytes at offset, relative to self.offset like s2n
+    def read(self, offset, length):
+        pos = self.offset + offset
+        if pos < self.base:
+            self.file.seek(pos)
+            return self.file.read(length)
+        end = self.base + len(self.data)
+        if pos + length > end:
+            if not self.eof and pos > end + TIFF_WINDOW:
+                return self._window(pos, length)
+            self._extend(pos + length)
+        pos -= self.base
+        return self.data[pos:pos + length]
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        pos = self.offset + offset - self.base
+        if pos >= 0 and pos + length <= len(self.data):
+            fmt = S2N_FORMATS.get((self.endian, length, signed))
+            if fmt:
+                return struct.unpack_from(fmt, self.data, pos)[0]
+        slice=self.read(offset, length)
+        if len(slice) == length and (self.endian, length, signed) in S2N_FORMATS:
+            return struct.unpack(S2N_FORMATS[(self.endian, length, signed)],
+                                 slice)[0]
+        # odd sizes and short reads at the end of the file
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1279,6 +1405,41 @@ class EXIF_header:
                 val=val-(msb << 1)
         return val
 
+    # struct byte order character for self.endian
+    def byte_order(self):
+        if self.endian == 'I':
+            return '<'
+        return '>'
+
+    # decode an array of count values of field_type at offset in one go,
+    # rather than calling s2n for every element. Ratios become Ratio objects
+    # unless ratios is false, then they are read as plain 8 byte integers.
+    def values_at(self, offset, field_type, count, ratios=True):
+        typelen = FIELD_TYPES[field_type][0]
+        signed = field_type in (6, 8, 9, 10)
+        ratio = ratios and field_type in (5, 10)
+        data = self.read(offset, count * typelen)
+        if len(data) == count * typelen:
+            if ratio:
+                fmt = S2N_FORMATS[(self.endian, 4, signed)]
+                nums = struct.unpack(fmt[0] + str(2 * count) + fmt[1], data)
+                return [Ratio(nums[i], nums[i + 1])
+                        for i in xrange(0, len(nums), 2)]
+            fmt = S2N_FORMATS[(self.endian, typelen, signed)]
+            return list(struct.unpack(fmt[0] + str(count) + fmt[1], data))
+        # the value runs past the end of the file, so decode it element by
+        # element and let s2n deal with the short reads
+        values = []
+        for dummy in range(count):
+            if ratio:
+                value = Ratio(self.s2n(offset, 4, signed),
+                              self.s2n(offset + 4, 4, signed))
+            else:
+                value = self.s2n(offset, typelen, signed)
+            values.append(value)
+            offset = offset + typelen
+        return values
+
     # convert offset to string
     def n2s(self, offset, length):
         s = ''
@@ -1313,12 +1474,26 @@ class EXIF_header:
         return a
 
     # return list of entries in this IFD
-    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF'):
+    # if only is given, just the tags with those names are decoded and we
+    # stop as soon as all of them are found
+    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF',
+                 only=None):
         entries=self.s2n(ifd, 2)
+        if only is not None:
+            only_left = len(only)
+            if not only_left:
+                return
+        # decode the whole entry table at once, as (tag, type, count, value
+        # or offset) quadruples; a table cut short by the end of the file
+        # just has fewer entries
+        table = self.read(ifd + 2, 12 * entries)
+        entries = len(table) // 12
+        fields = struct.unpack(self.byte_order() + 'HHI4s' * entries,
+                               table[:12 * entries])
         for i in range(entries):
             # entry is index of start of this IFD in the file
             entry = ifd + 2 + 12 * i
-            tag = self.s2n(entry, 2)
+            tag, field_type, count, pointer = fields[4 * i:4 * i + 4]
 
             # get tag name early to avoid errors, help debug
             tag_entry = dict.get(tag)
@@ -1327,10 +1502,11 @@ class EXIF_header:
             else:
                 tag_name = 'Tag 0x%04X' % tag
 
+            if only is not None and tag_name not in only:
+                continue
+
             # ignore certain tags for faster processing
             if not (not detailed and tag in IGNORE_TAGS):
-                field_type = self.s2n(entry + 2, 2)
-                
                 # unknown field type
                 if not 0 < field_type < len(FIELD_TYPES):
                     if not self.strict:
@@ -1339,7 +1515,6 @@ class EXIF_header:
                         raise ValueError('unknown type %d in tag 0x%04X' % (field_type, tag))
 
                 typelen = FIELD_TYPES[field_type][0]
-                count = self.s2n(entry + 4, 4)
                 # Adjust for tag id/type/count (2+2+4 bytes)
                 # Now we point at either the data or the 2nd level offset
                 offset = entry + 8
@@ -1353,13 +1528,13 @@ class EXIF_header:
                     # is for the Nikon type 3 makernote.  Other cameras may use
                     # other relative offsets, which would have to be computed here
                     # slightly differently.
+                    pointer = struct.unpack(self.byte_order() + 'I', pointer)[0]
                     if relative:
-                        tmp_offset = self.s2n(offset, 4)
-                        offset = tmp_offset + ifd - 8
+                        offset = pointer + ifd - 8
                         if self.fake_exif:
                             offset = offset + 18
                     else:
-                        offset = self.s2n(offset, 4)
+                        offset = pointer
 
                 field_offset = offset
                 if field_type == 2:
@@ -1367,8 +1542,7 @@ class EXIF_header:
                     # XXX investigate
                     # sometimes gets too big to fit in int value
                     if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
+                        values = self.read(offset, count)
                         #print values
                         # Drop any garbage after a null.
                         values = values.split('\x00', 1)[0]
@@ -1376,62 +1550,36 @@ class EXIF_header:
                         values = ''
                 else:
                     values = []
-                    signed = (field_type in [6, 8, 9, 10])
-                    
                     # XXX investigate
                     # some entries get too big to handle could be malformed
                     # file or problem with self.s2n
                     if count < 1000:
-                        for dummy in range(count):
-                            if field_type in (5, 10):
-                                # a ratio
-                                value = Ratio(self.s2n(offset, 4, signed),
-                                              self.s2n(offset + 4, 4, signed))
-                            else:
-                                value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                        values = self.values_at(offset, field_type, count)
                     # The test above causes problems with tags that are 
                     # supposed to have long values!  Fix up one important case.
                     elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
-                            value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                        values = self.values_at(offset, field_type, count,
+                                                ratios=False)
                     #else :
                     #    print "Warning: dropping large tag:", tag, tag_name
                 
-                # now 'values' is either a string or an array
-                if count == 1 and field_type != 2:
-                    printable=str(values[0])
-                elif count > 50 and len(values) > 20 :
-                    printable=str( values[0:20] )[0:-1] + ", ... ]"
-                else:
-                    printable=str(values)
-
-                # compute printable version of values
-                if tag_entry:
-                    if len(tag_entry) != 1:
-                        # optional 2nd tag element is present
-                        if callable(tag_entry[1]):
-                            # call mapping function
-                            printable = tag_entry[1](values)
-                        else:
-                            printable = ''
-                            for i in values:
-                                # use lookup table for this tag
-                                printable += tag_entry[1].get(i, repr(i))
-
-                self.tags[ifd_name + ' ' + tag_name] = IFD_Tag(printable, tag,
+                # now 'values' is either a string or an array, the
+                # printable version is only worked out if someone asks
+                self.tags[ifd_name + ' ' + tag_name] = IFD_Tag(None, tag,
                                                           field_type,
                                                           values, field_offset,
-                                                          count * typelen)
+                                                          count * typelen,
+                                                          tag_entry)
                 if self.debug:
                     print ' debug:   %s: %s' % (tag_name,
                                                 repr(self.tags[ifd_name + ' ' + tag_name]))
 
             if tag_name == stop_tag:
                 break
+            if only is not None:
+                only_left = only_left - 1
+                if not only_left:
+                    break
 
     # extract uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
@@ -1444,8 +1592,7 @@ class EXIF_header:
         else:
             tiff = 'II*\x00\x08\x00\x00\x00'
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff += self.read(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
 
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -1472,8 +1619,7 @@ class EXIF_header:
                     strip_off = newoff
                     strip_len = 4
                 # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                tiff += self.read(oldoff, count * typelen)
 
         # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
@@ -1484,8 +1630,7 @@ class EXIF_header:
             tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
             strip_off += strip_len
             # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
+            tiff += self.read(old_offsets[i], old_counts[i])
 
         self.tags['TIFFThumbnail'] = tiff
 
@@ -1610,10 +1755,60 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
+# IFD names in the order they have to be checked against a wanted key
+WANT_IFDS = ('EXIF Interoperability', 'Thumbnail', 'Image', 'EXIF', 'GPS')
+
+# dump only the IFDs and tags needed for the wanted keys
+def dump_wanted(hdr, want, debug=False):
+    names = {}
+    for key in want:
+        for ifd_name in WANT_IFDS:
+            if key.startswith(ifd_name + ' '):
+                names.setdefault(ifd_name, set()).add(key[len(ifd_name)+1:])
+                break
+    # the sub IFDs are only reachable through their offset tags
+    if 'EXIF Interoperability' in names:
+        names.setdefault('EXIF', set()).add('InteroperabilityOffset')
+    if 'EXIF' in names:
+        names.setdefault('Image', set()).add('ExifOffset')
+    if 'GPS' in names:
+        names.setdefault('Image', set()).add('GPSInfo')
+
+    ifd = hdr.first_IFD()
+    if debug:
+        print ' IFD 0 (Image) at offset %d:' % ifd
+    hdr.dump_IFD(ifd, 'Image', only=names.get('Image', ()))
+    if 'Thumbnail' in names:
+        ifd = hdr.next_IFD(ifd)
+        if ifd:
+            if debug:
+                print ' IFD 1 (Thumbnail) at offset %d:' % ifd
+            hdr.dump_IFD(ifd, 'Thumbnail', only=names['Thumbnail'])
+    exif_off = hdr.tags.get('Image ExifOffset')
+    if exif_off and 'EXIF' in names:
+        if debug:
+            print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
+        hdr.dump_IFD(exif_off.values[0], 'EXIF', only=names['EXIF'])
+        intr_off = hdr.tags.get('EXIF InteroperabilityOffset')
+        if intr_off and 'EXIF Interoperability' in names:
+            if debug:
+                print ' EXIF Interoperability SubSubIFD at offset %d:' \
+                      % intr_off.values[0]
+            hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
+                         dict=INTR_TAGS, only=names['EXIF Interoperability'])
+    gps_off = hdr.tags.get('Image GPSInfo')
+    if gps_off and 'GPS' in names:
+        if debug:
+            print ' GPS SubIFD at offset %d:' % gps_off.values[0]
+        hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS,
+                     only=names['GPS'])
+    return hdr.tags
+
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False,
+                 want=None):
     # yah it's cheesy...
     global detailed
     detailed = details
@@ -1625,10 +1820,9 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     data = f.read(12)
     if data[0:4] in ['II*\x00', 'MM\x00*']:
         # it's a TIFF file
-        f.seek(0)
-        endian = f.read(1)
-        f.read(1)
+        endian = data[0]
         offset = 0
+        size = TIFF_PREFIX
     elif data[0:2] == '\xFF\xD8':
         # it's a JPEG file
         while data[2] == '\xFF' and data[6:10] in ('JFIF', 'JFXX', 'OLYM', 'Phot'):
@@ -1641,6 +1835,9 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
             # detected EXIF header
             offset = f.tell()
             endian = f.read(1)
+            # the TIFF header runs to the end of the APP1 segment
+            length = ord(data[4])*256+ord(data[5])
+            size = max(length - 8, 8)
         else:
             # no EXIF information
             return {}
@@ -1651,7 +1848,9 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug, size)
+    if want is not None:
+        return dump_wanted(hdr, want, debug)
     ifd_list = hdr.list_IFDs()
     ctr = 0
     for i in ifd_list:
@@ -1695,9 +1894,8 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
     if thumb_off:
-        f.seek(offset+thumb_off.values[0])
         size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
+        hdr.tags['JPEGThumbnail'] = hdr.read(thumb_off.values[0], size)
 
     # deal with MakerNote contained in EXIF IFD
     # (Some apps use MakerNote tags but do not use a format for which we
@@ -1710,8 +1908,8 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     if 'JPEGThumbnail' not in hdr.tags:
         thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
         if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+            hdr.tags['JPEGThumbnail']=hdr.read(thumb_off.values[0],
+                                               thumb_off.field_length)
 
     return hdr.tags
 
@@ -1722,6 +1920,7 @@ def usage(exit_status):
     msg += 'Extract EXIF information from digital camera image files.\n\nOptions:\n'
     msg += '-q --quick   Do not process MakerNotes.\n'
     msg += '-t TAG --stop-tag TAG   Stop processing when this tag is retrieved.\n'
+    msg += '-w KEY --want KEY   Only retrieve this tag, e.g. "EXIF DateTimeOriginal".\n'
     msg += '-s --strict   Run in strict mode (stop on errors).\n'
     msg += '-d --debug   Run in debug mode (display extra info).\n'
     print msg
@@ -1734,13 +1933,14 @@ if __name__ == '__main__':
 
     # parse command line options/arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:v", ["help", "quick", "strict", "debug", "stop-tag="])
+        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:vw:", ["help", "quick", "strict", "debug", "stop-tag=", "want="])
     except getopt.GetoptError:
         usage(2)
     if args == []:
         usage(2)
     detailed = True
     stop_tag = 'UNDEF'
+    want = None
     debug = False
     strict = False
     for o, a in opts:
@@ -1754,6 +1954,10 @@ if __name__ == '__main__':
             strict = True
         if o in ("-d", "--debug"):
             debug = True
+        if o in ("-w", "--want"):
+            if want is None:
+                want = []
+            want.append(a)
 
     # output info for each file
     for filename in args:
@@ -1764,7 +1968,7 @@ if __name__ == '__main__':
             continue
         print filename + ':'
         # get the tags
-        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug)
+        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug, want=want)
         if not data:
             print 'No EXIF information found'
             continue
@@ -0,0 +1,172 @@
+'''
+Metadata backends, picked by the first bytes of a file.
+
+The create date of a file used to be looked for by its extension: EXIF.py
+and PIL when that failed for pictures, hachoir for videos. A misnamed
+file paid for every parser that could not read it. Now the start of the
+file is read once, sniff() tells which container it is from that, and
+only the backends that can read that container are tried, cheapest
+first. They get a PrefixedFile, so what was read to sniff is not read
+again.
+
+Stats counts per backend how often it found a date, found none, or
+failed, including in --jobs worker processes, which send theirs to the
+main process over a pipe.
+'''
+import os
+import threading
+import multiprocessing.queues
+import quicktime
+
+
+# bytes read to sniff, enough to hold the whole EXIF of a JPEG
+prefix_size = 64 * 1024
+# bytes readline looks at a time for the end of a line
+_line_chunk = 256
+# what a backend can make of a file
+outcomes = ('hit', 'no_date', 'failed')
+
+
+def sniff(prefix):
+    """Return the container of a file starting with prefix: jpeg, tiff
+    (also TIFF based raw formats like CR2, NEF and DNG), png, isobmff
+    (QuickTime and MP4) or riff (AVI), or None if it is none of these"""
+    if prefix[:2] == '\xFF\xD8':
+        return 'jpeg'
+    if prefix[:4] in ('II*\x00', 'MM\x00*'):
+        return 'tiff'
+    if prefix[:8] == '\x89PNG\r\n\x1a\n':
+        return 'png'
+    if prefix[:4] == 'RIFF' and prefix[8:12] in ('AVI ', 'AVIX'):
+        return 'riff'
+    if prefix[4:8] in quicktime.top_level:
+        return 'isobmff'
+    return None
+
+
+class PrefixedFile(object):
+    """Read only file object for f that reads the first size bytes once
+    and serves reads of them from memory"""
+
+    def __init__(self, f, size=prefix_size):
+        self.f = f
+        self.prefix = f.read(size)
+        # the whole file is in the prefix
+        self.complete = len(self.prefix) < size
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        data = ''
+        if self.pos < len(self.prefix):
+            if size is None:
+                data = self.prefix[self.pos:]
+            else:
+                data = self.prefix[self.pos:self.pos + size]
+            self.pos = self.pos + len(data)
+        if not self.complete and (size is None or len(data) < size):
+            self.f.seek(self.pos)
+            if size is None:
+                more = self.f.read()
+            else:
+                more = self.f.read(size - len(data))
+            self.pos = self.pos + len(more)
+            data = data + more
+        return data
+
+    def readline(self, size=-1):
+        # PIL plugins read text headers with it while probing
+        chunks = []
+        total = 0
+        while size is None or size < 0 or total < size:
+            start = self.pos
+            want = _line_chunk
+            if size is not None and size >= 0:
+                want = min(want, size - total)
+            data = self.read(want)
+            if not data:
+                break
+            end = data.find('\n') + 1
+            if end:
+                data = data[:end]
+                self.pos = start + end
+            chunks.append(data)
+            total = total + len(data)
+            if end:
+                break
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self.pos + offset
+        elif whence == 2:
+            if self.complete:
+                offset = len(self.prefix) + offset
+            else:
+                self.f.seek(offset, 2)
+                offset = self.f.tell()
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+
+class Stats(object):
+    """Counts what each backend made of the files it was given"""
+
+    def __init__(self):
+        # backend -> outcome -> files
+        self.counts = {}
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._queue = None
+
+    def collect(self):
+        """Take in the counts of worker processes too, from now on. Call
+        before they are started"""
+        self.pid = os.getpid()
+        self._queue = multiprocessing.queues.SimpleQueue()
+        self._drained = threading.Event()
+        drainer = threading.Thread(target=self._drain)
+        drainer.daemon = True
+        drainer.start()
+
+    def _drain(self):
+        while True:
+            sample = self._queue.get()
+            if sample is None:
+                self._drained.set()
+                return
+            self._add(*sample)
+
+    def _add(self, backend, outcome):
+        with self._lock:
+            counts = self.counts.setdefault(backend, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def record(self, backend, outcome):
+        """Count a file backend had outcome for, one of outcomes"""
+        if os.getpid() == self.pid:
+            self._add(backend, outcome)
+        elif self._queue is not None:
+            self._queue.put((backend, outcome))
+
+    def finish(self):
+        """Wait for the counts the worker processes sent. Call when the
+        workers are done"""
+        if self._queue is not None:
+            self._queue.put(None)
+            self._drained.wait()
+            self._queue = None
+
+    def summary(self):
+        """Return the counts as one line"""
+        return "; ".join(
+            backend + ": " + ", ".join(str(counts[outcome]) + " " + outcome
+                                       for outcome in outcomes
+                                       if counts.get(outcome))
+            for backend, counts in sorted(self.counts.items()))
@@ -0,0 +1,131 @@
+'''
+Persistent cache of extracted create dates.
+
+Nightly runs over the same archive re-parse every file even though almost
+nothing changed. The cache remembers the outcome of get_file_create_date()
+for each source file, including "no create date" but not "could not be
+read", in a SQLite database.
+An entry is only used while the file still has the same size, mtime and
+inode it had when it was parsed, otherwise it is parsed again and the entry
+replaced. Paths are stored as blobs, as they are byte strings that need not
+be UTF-8, which sqlite3 will not take as text.
+'''
+import os
+import sqlite3
+import datetime
+
+
+# bump when the stored columns change, older databases are then rebuilt
+_schema_version = 2
+_commit_every = 1000
+_date_format = '%Y-%m-%dT%H:%M:%S'
+
+
+def file_key(path, st=None):
+    """Return the identity of a file as (abspath, size, mtime, inode)"""
+    if st is None:
+        st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime, st.st_ino)
+
+
+def _blob(path):
+    if path is None:
+        return None
+    return sqlite3.Binary(path)
+
+
+def _path(blob):
+    if blob is None:
+        return None
+    return str(blob)
+
+
+class MetadataCache(object):
+    """Create dates of source files keyed by file_key()"""
+
+    def __init__(self, filename, rebuild=False):
+        filename = os.path.expanduser(filename)
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # the cache is opened by main() but used from the metadata stage's
+        # thread; only one thread ever touches it at a time
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if rebuild or version != _schema_version:
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute('PRAGMA user_version = %d' % _schema_version)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                               path BLOB PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               inode INTEGER,
+                               create_date TEXT,
+                               thm_filename BLOB,
+                               thm_fullpath BLOB,
+                               thm_mtime REAL,
+                               date_source TEXT)''')
+        self.db.commit()
+
+    def get(self, key):
+        """Return the cached get_file_create_date() result for key, or None
+        when the file is not cached or has changed since"""
+        path, size, mtime, inode = key
+        row = self.db.execute('SELECT size, mtime, inode, create_date, '
+                              'thm_filename, thm_fullpath, thm_mtime, '
+                              'date_source FROM files WHERE path = ?',
+                              (_blob(path),)).fetchone()
+        if not row or tuple(row[0:3]) != (size, mtime, inode):
+            self.misses = self.misses + 1
+            return None
+        (create_date, thm_filename, thm_fullpath, thm_mtime,
+         date_source) = row[3:]
+        thm_filename = _path(thm_filename)
+        thm_fullpath = _path(thm_fullpath)
+        if thm_fullpath:
+            # an avi is dated by its thm, so the thm has to be unchanged too
+            try:
+                if os.stat(thm_fullpath).st_mtime != thm_mtime:
+                    self.misses = self.misses + 1
+                    return None
+            except OSError:
+                self.misses = self.misses + 1
+                return None
+        if create_date:
+            create_date = datetime.datetime.strptime(create_date, _date_format)
+        self.hits = self.hits + 1
+        return (path, create_date, thm_filename, thm_fullpath, date_source)
+
+    def put(self, key, result):
+        """Remember the get_file_create_date() result for key"""
+        path, size, mtime, inode = key
+        file, create_date, thm_filename, thm_fullpath, date_source = result
+        if create_date:
+            create_date = create_date.replace(microsecond=0).isoformat()
+        thm_mtime = None
+        if thm_fullpath:
+            try:
+                thm_mtime = os.stat(thm_fullpath).st_mtime
+            except OSError:
+                return
+        self.db.execute('INSERT OR REPLACE INTO files VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (_blob(path), size, mtime, inode, create_date,
+                         _blob(thm_filename), _blob(thm_fullpath), thm_mtime,
+                         date_source))
+        self._pending = self._pending + 1
+        if self._pending >= _commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
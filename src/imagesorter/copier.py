@@ -0,0 +1,242 @@
+'''
+Copy engine for imagesorter.
+
+shutil.copy2 pushes every byte through userspace buffers. Copier.copy2 has
+the same semantics, but moves the data with the cheapest mechanism the
+filesystems support:
+
+    reflink          FICLONE ioctl, an instant copy-on-write clone on
+                     btrfs/XFS when source and target share a filesystem
+    copy_file_range  in-kernel copy, server side on some network filesystems
+    sendfile         in-kernel copy for older kernels
+    buffered         shutil.copyfileobj, works everywhere
+
+'auto' tries them in that order. Naming a method only tries that one and
+then falls back to buffered. A method that turns out to be unsupported
+between two devices is not tried again for that pair.
+
+Copier.place puts a file into the target according to a mode, which avoids
+copying data at all when source and target share a filesystem:
+
+    copy      copy2 as above
+    hardlink  hard link, falls back to copy2 across filesystems
+    symlink   symbolic link to the absolute source path
+    move      rename, or copy2, compare and unlink across filesystems
+'''
+import os
+import errno
+import shutil
+import filecmp
+import threading
+import ctypes
+import ctypes.util
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+methods = ('auto', 'reflink', 'copy_file_range', 'sendfile', 'buffered')
+modes = ('copy', 'hardlink', 'symlink', 'move')
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+# copy this much per copy_file_range/sendfile call
+_chunk = 64 * 1024 * 1024
+# errors that mean "this method does not work here", not "the copy failed"
+_unsupported = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                    errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY])
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _libc_function(name, argtypes):
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = argtypes
+    return func
+
+_copy_file_range = _libc_function('copy_file_range',
+                                  [ctypes.c_int, ctypes.c_void_p,
+                                   ctypes.c_int, ctypes.c_void_p,
+                                   ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libc_function('sendfile',
+                           [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t])
+
+
+class Unsupported(Exception):
+    """The copy method can not be used for this pair of files"""
+
+
+def _reflink(fsrc, fdst, size):
+    if fcntl is None:
+        raise Unsupported()
+    try:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except IOError as exc:
+        if exc.errno in _unsupported:
+            raise Unsupported()
+        raise
+
+
+def _kernel_copy(call, size):
+    """Run call(count) until it copies nothing, at the end of the file,
+    like shutil reads to the end rather than to size, the size the file had
+    when it was opened. call returns the number of bytes copied, 0 at end
+    of file or -1 with errno set"""
+    copied = 0
+    while True:
+        n = call(_chunk)
+        if n < 0:
+            err = ctypes.get_errno()
+            if copied == 0 and err in _unsupported:
+                raise Unsupported()
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            if copied == 0:
+                # some FUSE, overlay and proc like filesystems copy nothing
+                # and say so, like shutil we take it as unsupported
+                raise Unsupported()
+            if copied < size:
+                # the source got shorter while we copied it
+                raise IOError(errno.EIO, "copied only %d of %d bytes" %
+                              (copied, size))
+            return copied
+        copied = copied + n
+
+
+def _copy_range(fsrc, fdst, size):
+    if _copy_file_range is None:
+        raise Unsupported()
+    _kernel_copy(lambda count: _copy_file_range(fsrc.fileno(), None,
+                                                fdst.fileno(), None,
+                                                count, 0), size)
+
+
+def _send(fsrc, fdst, size):
+    if _sendfile is None:
+        raise Unsupported()
+    _kernel_copy(lambda count: _sendfile(fdst.fileno(), fsrc.fileno(),
+                                         None, count), size)
+
+
+def _buffered(fsrc, fdst, size):
+    shutil.copyfileobj(fsrc, fdst)
+
+
+_engines = (('reflink', _reflink), ('copy_file_range', _copy_range),
+            ('sendfile', _send), ('buffered', _buffered))
+
+
+class Copier(object):
+    """shutil.copy2 replacement that uses the given copy method, and
+    places files according to mode. Safe to use from several threads"""
+
+    def __init__(self, method='auto', mode='copy'):
+        if method not in methods:
+            raise ValueError('unknown copy method ' + method)
+        if mode not in modes:
+            raise ValueError('unknown mode ' + mode)
+        self.mode = mode
+        if method == 'auto':
+            self.engines = _engines
+        else:
+            self.engines = [e for e in _engines
+                            if e[0] in (method, 'buffered')]
+        # (method, source device, target device) known not to work
+        self.broken = set()
+        # files and bytes copied by each method, and files placed without
+        # copying by each mode
+        self.counts = dict((name, 0) for name in
+                           [e[0] for e in _engines] + list(modes[1:]))
+        self.bytes = dict((name, 0) for name, engine in _engines)
+        self._lock = threading.Lock()
+
+    def _count(self, name, size=0):
+        with self._lock:
+            self.counts[name] = self.counts[name] + 1
+            if size:
+                self.bytes[name] = self.bytes[name] + size
+
+    def copyfile(self, src, dst):
+        """Copy data from src to dst, like shutil.copyfile"""
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            raise shutil.Error("`%s` and `%s` are the same file" % (src, dst))
+        with open(src, 'rb') as fsrc:
+            st = os.fstat(fsrc.fileno())
+            with open(dst, 'wb') as fdst:
+                devices = (st.st_dev, os.fstat(fdst.fileno()).st_dev)
+                for name, engine in self.engines:
+                    if (name,) + devices in self.broken:
+                        continue
+                    if not st.st_size and name != 'buffered':
+                        # empty, or like the files of /proc it does not
+                        # tell how big it is, which only reading shows
+                        continue
+                    try:
+                        engine(fsrc, fdst, st.st_size)
+                    except Unsupported:
+                        self.broken.add((name,) + devices)
+                        continue
+                    except EnvironmentError:
+                        # no half copied file that would pass for done
+                        os.unlink(dst)
+                        raise
+                    self._count(name, st.st_size)
+                    return name
+
+    def copy2(self, src, dst):
+        """Copy src to dst, a file or directory, with its metadata like
+        shutil.copy2. Returns the name of the copy method used"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        name = self.copyfile(src, dst)
+        shutil.copystat(src, dst)
+        return name
+
+    def place(self, src, dst):
+        """Put src at dst, a file or directory, according to self.mode.
+        Returns the name of the mode or copy method used"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if self.mode == 'hardlink':
+            try:
+                os.link(src, dst)
+            except OSError as exc:
+                # other filesystem, or one without hard links
+                if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                return self.copy2(src, dst)
+        elif self.mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        elif self.mode == 'move':
+            try:
+                os.rename(src, dst)
+            except OSError as exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+                name = self.copy2(src, dst)
+                if not filecmp.cmp(src, dst, shallow=False):
+                    os.unlink(dst)
+                    raise OSError(errno.EIO, "copy of " + src + " to " +
+                                  dst + " does not match, source kept")
+                os.unlink(src)
+                return name
+        else:
+            return self.copy2(src, dst)
+        self._count(self.mode)
+        return self.mode
+
+    def summary(self):
+        """Return a one line description of the copy methods used"""
+        used = [name + ": " + str(self.counts[name]) + " files, " +
+                str(self.bytes[name]) + " bytes"
+                for name, engine in _engines if self.counts[name]]
+        used += [name + ": " + str(self.counts[name]) + " files"
+                 for name in modes[1:] if self.counts[name]]
+        return ", ".join(used)
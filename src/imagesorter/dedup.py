@@ -0,0 +1,136 @@
+'''
+Content index of the target library, used to skip duplicates.
+
+main() only used to skip a file when one with the same name already sat in
+the same date directory. The same photo imported twice under another name,
+or with another date, was copied again. The index remembers the size of
+every file in the target, and a SHA-1 of its content once it is needed, so
+a file is recognised as a duplicate whatever its name. Only files whose size
+matches something in the library are ever hashed. Paths are stored as
+blobs, as they are byte strings that need not be UTF-8, which sqlite3 will
+not take as text.
+'''
+import os
+import sqlite3
+import hashlib
+
+
+_schema_version = 2
+_commit_every = 1000
+_block = 1024 * 1024
+
+
+def file_digest(path):
+    """Return the hex SHA-1 of the content of path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_block)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContentIndex(object):
+    """Sizes and content hashes of the files under root"""
+
+    def __init__(self, filename, root, skip=()):
+        self.filename = filename
+        self.root = root
+        # directories under root that are not part of the library
+        self.skip = set(os.path.realpath(d) for d in skip)
+        self.skip.add(os.path.realpath(os.path.dirname(filename)))
+        self.duplicates = 0
+        self.bytes_saved = 0
+        self._pending = 0
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != _schema_version:
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute('PRAGMA user_version = %d' % _schema_version)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                               path BLOB PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               digest TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_size '
+                        'ON files (size)')
+        self.db.commit()
+
+    def refresh(self):
+        """Bring the index up to date with what is under root. Files that
+        changed lose their hash, files that are gone are dropped"""
+        known = dict((str(row[0]), (row[1], row[2])) for row in
+                     self.db.execute('SELECT path, size, mtime FROM files'))
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if os.path.realpath(
+                       os.path.join(root, d)) not in self.skip]
+            for name in files:
+                path = os.path.abspath(os.path.join(root, name))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if known.pop(path, None) != (st.st_size, st.st_mtime):
+                    self.add(path, st)
+        self.db.executemany('DELETE FROM files WHERE path = ?',
+                            [(sqlite3.Binary(path),) for path in known])
+        self.commit()
+
+    def find(self, path):
+        """Look for a file in the library with the same content as path.
+
+        Returns (match, digest) where match is the path of that file or
+        None, and digest is the hash of path if it had to be computed."""
+        size = os.path.getsize(path)
+        rows = self.db.execute('SELECT path, digest FROM files '
+                               'WHERE size = ?', (size,)).fetchall()
+        path = os.path.abspath(path)
+        # a file is not a duplicate of itself
+        rows = [(str(other), other_digest) for other, other_digest in rows
+                if str(other) != path]
+        if not rows:
+            return None, None
+        digest = file_digest(path)
+        for other, other_digest in rows:
+            if other_digest is None:
+                try:
+                    other_digest = file_digest(other)
+                except IOError:
+                    # gone since the index was refreshed
+                    self.db.execute('DELETE FROM files WHERE path = ?',
+                                    (sqlite3.Binary(other),))
+                    continue
+                self.db.execute('UPDATE files SET digest = ? '
+                                'WHERE path = ?',
+                                (other_digest, sqlite3.Binary(other)))
+            if other_digest == digest:
+                self.duplicates = self.duplicates + 1
+                self.bytes_saved = self.bytes_saved + size
+                return other, digest
+        return None, digest
+
+    def add(self, path, st=None, digest=None):
+        """Add path, just placed in the library, to the index"""
+        path = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                        (sqlite3.Binary(path), st.st_size, st.st_mtime,
+                         digest))
+        self._pending = self._pending + 1
+        if self._pending >= _commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,173 @@
+'''
+Structured event log for imagesorter.
+
+main() used to format a line for every file and write it, synchronously,
+to both the console and a log file. EventLog.emit only puts the event on a
+queue. A writer thread turns events into JSON lines in the log file,
+rotating it when it gets big, and keeps the console down to errors and a
+one line summary every few seconds. Events from --jobs worker processes
+reach it over a pipe.
+
+Every line is a JSON object with the time and the name of the event, and
+whatever else was given, e.g.
+
+    {"event": "placed", "n": 12, "src": "/photos/IMG_0012.JPG",
+     "dest": "/sorted/2013/October/2013_10_10", "time": 1381400000.5}
+
+Messages logged with the logging module become "log" events, through
+EventHandler.
+'''
+import os
+import sys
+import json
+import time
+import Queue
+import logging
+import threading
+import multiprocessing.queues
+
+
+# rotate the log when it is this big, keeping this many old ones
+_max_bytes = 64 * 1024 * 1024
+_backups = 5
+# seconds between summaries on the console
+_summary_every = 10
+# per file events, in the order the summary lists them
+summary_events = ('placed', 'exists', 'duplicate', 'no_date', 'failed')
+
+
+def _encode(fields):
+    try:
+        return json.dumps(fields, sort_keys=True)
+    except UnicodeDecodeError:
+        # file names that are not UTF-8
+        return json.dumps(dict(
+            (key, value.decode('utf-8', 'replace')
+             if isinstance(value, str) else value)
+            for key, value in fields.items()), sort_keys=True)
+
+
+class EventLog(object):
+    """JSON lines event log, written by a thread of its own"""
+
+    def __init__(self, filename, max_bytes=_max_bytes, backups=_backups,
+                 console=sys.stderr, summary_every=_summary_every):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.console = console
+        self.summary_every = summary_every
+        self.counts = dict((event, 0) for event in summary_events)
+        self.f = open(filename, 'a')
+        self.size = os.path.getsize(filename)
+        self.pid = os.getpid()
+        self.closed = False
+        self._queue = Queue.Queue()
+        # events from worker processes, and a thread to take them in
+        self._pipe = multiprocessing.queues.SimpleQueue()
+        self._receiver = threading.Thread(target=self._receive)
+        self._receiver.daemon = True
+        self._receiver.start()
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, event, **fields):
+        """Log event. Events with level='error' are shown on the console
+        too"""
+        fields['event'] = event
+        fields['time'] = time.time()
+        if os.getpid() != self.pid:
+            self._pipe.put(fields)
+        else:
+            self._queue.put(fields)
+
+    def _receive(self):
+        while True:
+            fields = self._pipe.get()
+            self._queue.put(fields)
+            if fields is None:
+                return
+
+    def _write(self):
+        summarised = time.time()
+        last_summary = None
+        while True:
+            try:
+                fields = self._queue.get(timeout=self.summary_every)
+            except Queue.Empty:
+                fields = {}
+            if fields is None:
+                break
+            if fields:
+                self._line(fields)
+            if self._queue.empty():
+                self.f.flush()
+            if time.time() - summarised >= self.summary_every:
+                summarised = time.time()
+                summary = self.summary()
+                if summary != last_summary:
+                    self._show(summary)
+                    last_summary = summary
+        self.f.close()
+
+    def _line(self, fields):
+        event = fields['event']
+        if event in self.counts:
+            self.counts[event] = self.counts[event] + 1
+        if fields.get('level') == 'error' and event != 'log':
+            # log events are on the console already, through logging
+            self._show(event + ": " + " ".join(
+                "%s=%s" % (key, fields[key]) for key in sorted(fields)
+                if key not in ('event', 'level', 'time')))
+        line = _encode(fields) + '\n'
+        if self.max_bytes and self.size + len(line) > self.max_bytes:
+            self._rotate()
+        self.f.write(line)
+        self.size = self.size + len(line)
+
+    def _rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.filename, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.filename, i + 1))
+        if self.backups:
+            os.rename(self.filename, self.filename + ".1")
+        self.f = open(self.filename, 'w')
+        self.size = 0
+
+    def _show(self, text):
+        if self.console:
+            self.console.write(text + '\n')
+            self.console.flush()
+
+    def summary(self):
+        """Return the counts of the per file events as one line"""
+        return ", ".join("%d %s" % (self.counts[event], event)
+                         for event in summary_events if self.counts[event])
+
+    def close(self):
+        """Write out every event and stop. Events from worker processes
+        have to be sent by now"""
+        if self.closed:
+            return
+        self.closed = True
+        self._pipe.put(None)
+        self._receiver.join()
+        self._writer.join()
+
+
+class EventHandler(logging.Handler):
+    """Puts log records into an EventLog as "log" events"""
+
+    def __init__(self, events):
+        logging.Handler.__init__(self)
+        self.events = events
+
+    def emit(self, record):
+        try:
+            self.events.emit('log', level=record.levelname.lower(),
+                             message=self.format(record))
+        except Exception:
+            self.handleError(record)
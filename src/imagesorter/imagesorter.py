@@ -8,10 +8,19 @@ NAME
     based on year/month and date taken from the exif data of the image
 
 SYNOPSIS
-    imagesorter [hvs:t:f:]
+    imagesorter [plan|apply] [hvs:t:f:j:c:m:drp:]
 
 Usage:
-    % imagesorter -s /path/to/source -t /path/to/target [-f format]
+    % imagesorter -s /path/to/source -t /path/to/target [-f format] [-j jobs]
+                  [-c cachefile [--rebuild-cache]] [--copy-method method]
+                  [-m mode] [-d] [-r] [--walk-threads threads]
+                  [--read-threads threads] [--copy-threads threads]
+                  [--profile report] [--metrics-file file]
+                  [--metrics-port port] [--log-dir dir]
+    % imagesorter plan -p plan.jsonl -s /path/to/source [-t /path/to/target]
+                  [-f format] [-j jobs] [-c cachefile]
+    % imagesorter apply -p plan.jsonl [-s /path/to/source] [-t /path/to/target]
+                  [-m mode] [-r] [--copy-threads threads]
 
     where /path/to/source is where all the images are stored
     and /path/to/target is where images will be sorted
@@ -50,20 +59,149 @@ Usage:
                            mmmm month as a full name (January-December)
                            yy   year as a two-digit number (00-99)
                            yyyy year as a four digit number
-
-    A log file is created in the same location where you would run the script.
+    -j --jobs              Number of worker processes used to extract create
+                           dates. Files are still copied one at a time and in
+                           the order they were found. Default is 1, which
+                           does everything in a single process.
+    --walk-threads         Number of threads listing source directories at
+                           the same time. Worth raising for sources on a
+                           network filesystem, where the walk is slowed down
+                           by the round trip per directory. Files are then
+                           processed in the order their directories were
+                           listed. Default is 1.
+    --read-threads         Number of files whose create date is read at the
+                           same time, by threads. Meant for sources where
+                           every open and read waits on the network rather
+                           than the CPU. Ignored with -j. Default is 1.
+    --copy-threads         Number of files put into the target at the same
+                           time. Which files to copy is still decided one at
+                           a time and in order, only the copying overlaps.
+                           Files with the same content that are in flight
+                           together are not recognised by -d. Default is 1.
+    --inject-latency       Milliseconds to wait before every file read and
+                           copy, to try the options above out on a local
+                           directory as if it was on slow storage.
+    --profile              File to write a JSON report of where the time
+                           went to: calls, wall and CPU time and a histogram
+                           of call times for every stage (walk, extract,
+                           exif, pil, quicktime, riff, hachoir, cache, dedup,
+                           mkdir, copy, journal, log), how dates were found,
+                           how often each metadata backend found a date,
+                           found none or failed, copy methods used and peak
+                           memory use.
+    --metrics-file         File to keep the live metrics of the run in, in
+                           the Prometheus text format. It is rewritten every
+                           few seconds with the counters below, bytes copied,
+                           files/s and bytes/s over the last minute, the ETA
+                           and how many files wait before each stage.
+                           Point the textfile collector of node_exporter at
+                           it, or just cat it.
+    --metrics-port         Serve the same metrics on
+                           http://127.0.0.1:port/metrics, and as JSON on
+                           /status.
+    --log-dir              Directory to write the log of the run to. Default
+                           is the current directory.
+    -p --plan              Plan file written by imagesorter plan and read by
+                           imagesorter apply, see below.
+    -c --cache             SQLite file to cache create dates in between runs.
+                           A file is only parsed again when its size, mtime
+                           or inode changed since it was cached.
+                           e.g. ~/.cache/imagesorter.db
+    --rebuild-cache        Throw away everything in the cache and parse all
+                           files again.
+    --copy-method          How file data is copied, one of
+                           auto            try the methods below in order
+                           reflink         clone the file on btrfs/XFS when
+                                           source and target share a
+                                           filesystem, no data is copied
+                           copy_file_range copy inside the kernel
+                           sendfile        copy inside the kernel on older
+                                           kernels
+                           buffered        copy through userspace buffers
+                                           like shutil.copy2
+                           Any method falls back to buffered when it can not
+                           be used. File metadata is always copied like
+                           shutil.copy2 does. Default is auto.
+    -m --mode              How files are put into the target, one of
+                           copy      copy the file (default)
+                           hardlink hard link the file, copies it when
+                                     source and target are on different
+                                     filesystems
+                           symlink   symbolic link to the source file
+                           move      move the file. Across filesystems it
+                                     is copied, compared with the source
+                                     and only then removed from the source
+    -d --dedup             Skip files whose content already exists anywhere
+                           in the target, whatever their name or date. An
+                           index of the target is kept in
+                           target/.imagesorter/content.db. Files are only
+                           hashed when their size matches a file in the
+                           target.
+    -r --resume            Carry on with a run that was interrupted. Every
+                           run records the files it is done with in
+                           target/.imagesorter/journal, and with this option
+                           those files are skipped without being looked at
+                           again. Without it the journal is started afresh.
+
+    Every run logs what happened to each file, and everything printed, to
+    imagesorter.<yyyymmddhhmmss>.jsonl in the log directory, one JSON
+    object per line. Copies and skips only show on the console as a
+    summary every 10 seconds, failures show as they happen. The log is
+    rotated at 64MB, keeping 5 old ones.
+
+    Which parser reads the create date of a file is picked by its first
+    bytes, not its name: EXIF.py for JPEG, TIFF and the raw formats based
+    on it, and PIL when EXIF.py can not parse it, PIL for PNG, the built
+    in readers and then hachoir for QuickTime, MP4 and AVI. Files none of
+    these are get the parsers of their extension. Parser failures go to the
+    log of the run, how each parser did is logged at the end of the run.
+
+    Sorting can also be split in two. imagesorter plan walks the source and
+    finds the create dates like a run would, but only writes down where
+    every file goes, and its size, to the plan file given with -p. Nothing
+    is copied and the target is not needed, so it doubles as a dry run.
+    imagesorter apply then places the files of the plan. Source and target
+    default to the ones the plan was made with, -s and -t point it
+    somewhere else, e.g. on the storage host where the plan is applied.
+    Before anything is written apply works out how many bytes the files it
+    still has to place take, and stops if the target does not have the
+    room for them. It places --copy-threads files at a time, 4 by default,
+    and logs the bytes placed and the time to go every 10 seconds. -m and
+    -r work like they do for a run; -d, --profile and the metrics are not
+    used by plan and apply.
 '''
 import sys
 import EXIF
+import pipeline
+import cache
+import copier
+import dedup
+import journal
+import instrument
+import metrics
+import events
+import listing
+import plan
+import quicktime
+import riff
+import backends
 import datetime
+# strptime imports this on first use, which races when that is in threads
+import _strptime
 import os.path
 import time
 import os
+import atexit
 import errno
-import shutil
+import socket
 import getopt
 import logging
 import calendar
+import re
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.pool
 from hachoir_core.error import HachoirError
 from hachoir_core.cmd_line import unicodeFilename
 from hachoir_parser import createParser
@@ -77,6 +215,47 @@ from PIL.ExifTags import TAGS #@UnresolvedImport
 _version = 0.2
 _source = ""
 _target = ""
+_chunksize = 16
+# the only EXIF tag the sorter looks at
+_date_tags = ('EXIF DateTimeOriginal',)
+# files that go with a source file, by lower case extension
+_sidecars = {'avi': ('thm',)}
+_queue_size = 1000
+# seconds between progress lines of imagesorter apply
+_progress_every = 10
+# functions timed with --profile, and the stage they are in
+_profiled = [('get_file_create_date', 'extract'), ('read_exif_date', 'exif'),
+             ('read_pil_date', 'pil'), ('read_quicktime_date', 'quicktime'),
+             ('read_riff_date', 'riff'),
+             ('get_hachoir_create_date', 'hachoir'), ('ensure_dir', 'mkdir'),
+             ('place_files', 'copy')]
+# metadata backends to try for each backends.sniff() container, cheapest
+# first. The next one is only tried when a backend fails, or when it finds
+# no date and is not in _conclusive_backends
+_backends = {
+    'jpeg': ('exif', 'pil'),
+    'tiff': ('exif', 'pil'),
+    'png': ('pil',),
+    'isobmff': ('quicktime', 'hachoir'),
+    'riff': ('riff', 'hachoir'),
+}
+# and for files of no container sniff() knows, by lower case extension
+_fallback_backends = {'avi': ('hachoir',), 'mov': ('hachoir',),
+                      'mp4': ('hachoir',)}
+_default_backends = ('exif', 'pil')
+# backends that read the metadata of a file whole, so when they find no
+# date there is none. hachoir knows more than the native video readers
+_conclusive_backends = ('exif', 'pil')
+# backend -> name of its function, looked up when called so --profile
+# times it
+_backend_functions = {'exif': 'read_exif_date', 'pil': 'read_pil_date',
+                      'quicktime': 'read_quicktime_date',
+                      'riff': 'read_riff_date', 'hachoir': 'read_hachoir_date'}
+backend_stats = backends.Stats()
+
+log = logging.getLogger()
+# the events.EventLog of the run, set by main()
+event_log = None
 
 
 def version():
@@ -132,13 +311,7 @@ def get_pil_exif_data(fname):
     global log
     ret = {}
     try:
-        img = Image.open(fname)
-        if hasattr(img, '_getexif'):
-            exifinfo = img._getexif()
-            if exifinfo != None:
-                for tag, value in exifinfo.items():
-                    decoded = TAGS.get(tag, tag)
-                    ret[decoded] = value
+        ret = _pil_exif(Image.open(fname))
     except IOError:
         log.critical( 'IOERROR ' + fname)
     except:
@@ -147,13 +320,24 @@ def get_pil_exif_data(fname):
     return ret
 
 
+def _pil_exif(img):
+    ret = {}
+    if hasattr(img, '_getexif'):
+        exifinfo = img._getexif()
+        if exifinfo != None:
+            for tag, value in exifinfo.items():
+                decoded = TAGS.get(tag, tag)
+                ret[decoded] = value
+    return ret
+
+
 def get_exif_data(fname):
     """Get embedded EXIF data from image file."""
     global log
     tags = {}
     try:
         img = open(fname, 'rb')
-        tags = EXIF.process_file(img)
+        tags = EXIF.process_file(img, want=_date_tags)
         img.close()
     except IOError:
         log.critical('IOERROR ' + fname)
@@ -197,6 +381,78 @@ def get_create_date(exif_data):
     return retval
 
 
+def read_exif_date(fname, f):
+    """exif backend: create date in the EXIF of a JPEG or TIFF"""
+    return get_create_date(EXIF.process_file(f, want=_date_tags))
+
+
+def read_pil_date(fname, f):
+    """pil backend: create date in the EXIF PIL finds in an image"""
+    return get_create_date(_pil_exif(Image.open(f)))
+
+
+def read_quicktime_date(fname, f):
+    """quicktime backend: create date of a QuickTime or MP4 file"""
+    return quicktime.read_creation_date(f)
+
+
+def read_riff_date(fname, f):
+    """riff backend: create date of an AVI file"""
+    return riff.read_creation_date(f)
+
+
+def read_hachoir_date(fname, f):
+    """hachoir backend: create date of any video hachoir can parse. It
+    opens fname itself"""
+    return get_hachoir_create_date(fname)
+
+
+def read_create_date(fname):
+    """Get create date of fname with the metadata backends for what its
+    first bytes say it is, or its extension if they say nothing.
+
+    The file is opened and its start read once, for all backends. Returns
+    (create_date, backend), backend being the one that found the date, or
+    the last one that read the file and found none. It is None if fname
+    could not be read at all, or every backend failed on it, so another
+    try may well find a date.
+    """
+    try:
+        f = open(fname, 'rb')
+    except IOError:
+        log.critical('IOERROR ' + fname)
+        return None, None
+    parsed = None
+    with f:
+        try:
+            shared = backends.PrefixedFile(f)
+        except IOError:
+            log.critical('IOERROR ' + fname)
+            return None, None
+        names = _backends.get(backends.sniff(shared.prefix))
+        if names is None:
+            ext = os.path.splitext(fname)[1][1:].lower()
+            names = _fallback_backends.get(ext, _default_backends)
+        for name in names:
+            shared.seek(0)
+            try:
+                create_date = globals()[_backend_functions[name]](fname, shared)
+            except Exception, err:
+                backend_stats.record(name, 'failed')
+                if event_log:
+                    event_log.emit('backend_failed', src=fname, backend=name,
+                                   error=str(err))
+                continue
+            if create_date:
+                backend_stats.record(name, 'hit')
+                return create_date, name
+            backend_stats.record(name, 'no_date')
+            parsed = name
+            if name in _conclusive_backends:
+                break
+    return None, parsed
+
+
 def has_thm_file(filename):
     """For given thm filename, find corresponding avi file. Return true if found """
     retval = (False, '', '')
@@ -212,66 +468,475 @@ def has_thm_file(filename):
         retval = (True, f_name+'.THM', thm_file1)
     return retval
 
-def createdirpath(format, tstamp, target=None):
-    """Return target directory location based on format and date"""
-    format = format.replace('yyyy','%Y')
-    format = format.replace('yy','%y')
-    format = format.replace('mmmm','%B')
-    format = format.replace('mmm','%b')
-    format = format.replace('mm','%m')
-    # temp replace any %m to place holder  %1
-    format = format.replace('%m','%1')
-    # change m to place holder %2 which will be replaced with %m
-    # and lstrip on 0 right before we produce the output
-    format = format.replace('m','%2')
-    # change back place holder %1 to %m
-    format = format.replace('%1','%m')
-    format = format.replace('dddd','%A')
-    format = format.replace('ddd','%a')
-    format = format.replace('dd','%d')
-    # temp replace any %d to place holder %1
-    format = format.replace('%d', '%1')
-    # change d to placeholder %3 to be later replaced with lstrip %d
-    format = format.replace('d','%3')
-    # revert place holder back to %d
-    format = format.replace('%1','%d')
-
-    # begin special cases for singe d and singe m
-    # replace %2 with real month without leading 0
-    month_no_lead_zero = tstamp.strftime('%m').lstrip('0')
-    format = format.replace('%2',month_no_lead_zero)
-    # replace %3 with real day without leading 0
-    day_no_leading_zero = tstamp.strftime('%d').lstrip('0')
-    format = format.replace('%3',day_no_leading_zero)
-    # end special cases
-
-    has_folder = None
-    formatted_str = tstamp.strftime(format)
-    if formatted_str.find("/") > 0:
-        tokens = formatted_str.split("/")
-        has_folder = True
-    elif formatted_str.find("\\") > 0:
-        tokens = formatted_str.split("\\")
-        has_folder = True
-    else:
-        tokens = formatted_str
 
-    if has_folder:
-        if target:
-            destpath = os.path.join(target, *tokens)
-        else:
-            destpath = os.path.join(*tokens)
+def get_file_create_date(file, sidecars=None):
+    """Get create date of an image or video file.
+
+    This is the metadata stage of main() and runs in the worker processes
+    when --jobs is used, so it only returns plain picklable values:
+    (file, create_date, thm_filename, thm_fullpath, date_source) where
+    date_source is 'thm' or the backend read_create_date() returned, and
+    None if the file could not be read.
+
+    sidecars are the names of the files next to file that go with it, as
+    found by pipeline.FileWalker. If None, the thm file is looked for.
+    """
+    filename = os.path.basename(file)
+    has_thm = False
+    thm_filename = None
+    thm_fullpath = None
+    if filename.lower().endswith('avi'):
+        if sidecars is None:
+            has_thm, thm_filename, thm_fullpath = has_thm_file(file)
+        elif sidecars:
+            has_thm = True
+            thm_filename = sidecars[0]
+            thm_fullpath = os.path.join(os.path.dirname(file), thm_filename)
+
+    if has_thm:
+        create_date, backend = read_create_date(thm_fullpath)
+        date_source = backend and 'thm'
     else:
-        if target:
-            destpath = os.path.join(target, tokens)
+        thm_filename = None
+        thm_fullpath = None
+        create_date, date_source = read_create_date(file)
+
+    return (file, create_date, thm_filename, thm_fullpath, date_source)
+
+
+def _walked_file_create_date(item):
+    file, sidecars, st = item
+    return get_file_create_date(file, sidecars)
+
+
+def extract_create_dates(files, metadata_cache=None, pool=None, jobs=1,
+                         chunksize=_chunksize, latency=0):
+    """Metadata stage of main(). Yield get_file_create_date() for files,
+    the (path, sidecars, st) items of pipeline.FileWalker.
+
+    Results come out in the same order as files. Files that are unchanged
+    since they were put in metadata_cache are answered from it, the rest are
+    parsed, in pool of jobs processes or threads if one is given, chunksize
+    files at a time, and added to the cache. latency seconds are added to
+    every file parsed, to simulate slow storage.
+    """
+    if metadata_cache is None:
+        extract = _walked_file_create_date
+        if latency:
+            extract = pipeline.Delayed(extract, latency)
+        if pool:
+            return pipeline.ordered_imap(pool, extract, files, jobs * 2,
+                                         chunksize)
+        return itertools.imap(extract, files)
+    return _extract_cached_create_dates(files, metadata_cache, pool, jobs,
+                                        chunksize, latency)
+
+
+def _extract_cached_create_dates(files, metadata_cache, pool, jobs,
+                                 chunksize, latency):
+    extract = _walked_file_create_date
+    if latency:
+        extract = pipeline.Delayed(extract, latency)
+    if pool is None:
+        chunksize = 1
+    # files waiting to be yielded behind the oldest one still being parsed.
+    # Past this many it is waited for, and a partly filled chunk of misses
+    # is sent off, so memory stays flat however sparse the misses are
+    backlog_size = jobs * 2 * chunksize
+    # (key, cached result, or the pipeline.Chunk parsing it and its index)
+    backlog = collections.deque()
+    chunk = pipeline.Chunk(pool, extract)
+    files = iter(files)
+    while True:
+        item = next(files, None)
+        if item is not None:
+            try:
+                key = cache.file_key(item[0], item[2])
+            except OSError:
+                key = None
+            hit = key and metadata_cache.get(key)
+            if hit:
+                backlog.append((None, (item[0],) + hit[1:], None, None))
+            else:
+                # no stat results to the workers, they don't need them
+                index = chunk.add(item[:2] + (None,))
+                backlog.append((key, None, chunk, index))
+        if chunk.items and (item is None or len(chunk.items) >= chunksize or
+                            (backlog[0][2] is chunk and
+                             len(backlog) > backlog_size)):
+            chunk.submit()
+            chunk = pipeline.Chunk(pool, extract)
+        while backlog:
+            key, result, parsing, index = backlog[0]
+            if parsing is not None:
+                if not parsing.submitted:
+                    break
+                if (item is not None and len(backlog) <= backlog_size and
+                        not parsing.ready()):
+                    break
+                result = parsing.result(index)
+                # a file that could not be read is tried again next time,
+                # it may have been a passing I/O error
+                if key and result[4] is not None:
+                    metadata_cache.put(key, result)
+            backlog.popleft()
+            yield result
+        if item is None:
+            break
+    metadata_cache.commit()
+
+
+def place_files(place, placements):
+    """Copy stage of main(). Put the (source, directory) placements into
+    the target with place, a Copier.place, and return the exception each
+    one raised, or None. Runs in the copy threads with --copy-threads."""
+    errors = []
+    for src, destdir in placements:
+        try:
+            place(src, destdir)
+        except EnvironmentError as exc:
+            errors.append(exc)
         else:
-            destpath = os.path.join(tokens)
+            errors.append(None)
+    return errors
+
+
+def finish_placements(finished, event_log, run_journal, target_index,
+                      content_index=None):
+    """Log and record the placements that are done, the (context, errors)
+    a pipeline.Window returns for place_files calls. context is (n, file,
+    placements, digest, done_dest), with placements (kind, source,
+    directory, destination, size) and size None when it is not known.
+    Returns the number of files copied and failed, and of bytes done with"""
+    copied = 0
+    failed = 0
+    done = 0
+    for (n, file, placements, digest, done_dest), errors in finished:
+        for (kind, src, destdir, dest, size), exc in zip(placements, errors):
+            done = done + (size or 0)
+            if exc is None:
+                if kind != 'problem':
+                    event_log.emit('placed', n=n, src=src, dest=destdir)
+                if kind == 'file':
+                    copied = copied + 1
+                    if content_index:
+                        content_index.add(dest, digest=digest)
+                continue
+            # it was claimed in the index when it was submitted
+            target_index.discard(dest)
+            # try it again when resuming
+            done_dest = None
+            event_log.emit('failed', level='error', n=n, src=src,
+                           dest=destdir, error=str(exc))
+            if kind == 'file':
+                failed = failed + 1
+        if done_dest:
+            run_journal.record(file, done_dest)
+    return copied, failed, done
+
+
+def ensure_dir(path, ensured=None):
+    """Create directory path, and its parents, unless it already exists.
+
+    ensured is a set of the directories already created or found during
+    this run, so each one costs at most one makedirs however many files go
+    into it. Returns True if path was created, so is empty.
+    """
+    if ensured is not None and path in ensured:
+        return False
+    created = True
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            created = False
+        else:
+            raise
+    if ensured is not None:
+        ensured.add(path)
+    return created
+
+
+def problem_dir(path):
+    """Return the directory under the target that path, a file without a
+    create date, goes to: exif_problems and the absolute path of the
+    directory it is in"""
+    return os.path.join("exif_problems",
+                        os.path.dirname(os.path.abspath(path))[1:])
+
+
+def _extraction_pool(jobs=1, read_threads=1):
+    """Return (pool, slots, chunksize) for extract_create_dates: worker
+    processes for jobs, else threads for read_threads, else no pool"""
+    if jobs > 1:
+        log.info("extracting create dates with " + str(jobs) + " worker processes")
+        return multiprocessing.Pool(jobs), jobs, _chunksize
+    if read_threads > 1:
+        log.info("extracting create dates with " + str(read_threads) + " threads")
+        # threads wait on storage, not the CPU, keep them all busy
+        return (multiprocessing.pool.ThreadPool(read_threads), read_threads,
+                1)
+    return None, 1, _chunksize
+
+
+def make_plan(plan_file, source, target, dir_format, formats, event_log,
+              jobs=1, read_threads=1, walk_threads=1, metadata_cache=None,
+              latency=0):
+    """imagesorter plan. Find the create date of every file in source and
+    write where it goes to plan_file, without touching the target.
+    Returns the plan.PlanWriter, for its counts"""
+    writer = plan.PlanWriter(plan_file, source, target, dir_format)
+    walker = pipeline.FileWalker(source, formats, target, (), _sidecars,
+                                 stat=metadata_cache is not None,
+                                 threads=walk_threads)
+    files = pipeline.bounded(walker, _queue_size)
+    pool, slots, chunksize = _extraction_pool(jobs, read_threads)
+    results = extract_create_dates(files, metadata_cache, pool, slots,
+                                   chunksize, latency)
+    n = 0
+    try:
+        for file, create_date, thm_filename, thm_fullpath, date_source in results:
+            n = n + 1
+            if create_date:
+                entries = [('file', file,
+                            createdirpath(dir_format, create_date))]
+                if thm_fullpath is not None:
+                    entries.append(('thm', thm_fullpath, entries[0][2]))
+            else:
+                event_log.emit('no_date', n=n, src=file)
+                # relative to the source, like the sources of the plan.
+                # apply_plan puts it under problem_dir() of the file
+                orig_path = os.path.dirname(
+                    os.path.relpath(os.path.abspath(file), writer.source))
+                entries = [('problem', file,
+                            os.path.join("exif_problems", orig_path)
+                            if orig_path else "exif_problems")]
+            try:
+                sizes = [os.path.getsize(src) for kind, src, destdir in entries]
+            except OSError as exc:
+                event_log.emit('failed', level='error', n=n, src=file,
+                               error=str(exc))
+                continue
+            for (kind, src, destdir), size in zip(entries, sizes):
+                writer.add(kind, src, destdir, size)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if metadata_cache:
+            metadata_cache.close()
+        writer.close()
+    return writer
+
+
+def _plan_units(entries):
+    """Group the entries of a plan into lists of a file and its sidecars"""
+    units = []
+    for entry in entries:
+        if entry[0] == 'thm' and units:
+            units[-1].append(entry)
+        else:
+            units.append([entry])
+    return units
+
+
+def free_space(path):
+    """Return the bytes we may still write to the filesystem of path"""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _progress(done, total, elapsed):
+    line = "placed %d of %d bytes" % (done, total)
+    if done and elapsed > 0:
+        rate = done / elapsed
+        eta = datetime.timedelta(seconds=int((total - done) / rate))
+        line = line + ", %.1f MB/s, %s to go" % (rate / 1e6, eta)
+    return line
+
+
+def apply_plan(entries, source, target, copy, event_log, copy_threads=4,
+               resume=False, latency=0):
+    """imagesorter apply. Put the files of a plan, the entries plan.read()
+    returns, from source into target with copy, a Copier, copy_threads
+    files at a time.
+
+    What to place is worked out before anything is written, so the run can
+    be called off when the target does not have the room for it. Returns
+    the number of files (copied, skipped, done before, failed), or None if
+    it was called off.
+    """
+    run_journal = journal.Journal(
+        os.path.join(target, ".imagesorter", "journal"), resume)
+    target_index = listing.TargetIndex()
+    # (n, file, placements, done_dest) of the files to place, with
+    # placements (kind, source, directory, destination, size)
+    todo = []
+    needed = 0
+    skipped = 0
+    done_before = 0
+    n = 0
+    for unit in _plan_units(entries):
+        n = n + 1
+        file = os.path.join(source, unit[0][1])
+        if os.path.abspath(file) in run_journal.done:
+            done_before = done_before + 1
+            continue
+        done_dest = None
+        placements = []
+        for kind, src, destdir, size in unit:
+            src = os.path.join(source, src)
+            if kind == 'problem':
+                # where a run without a plan puts it
+                destdir = problem_dir(src)
+            destdir = os.path.join(target, destdir)
+            dest = os.path.join(destdir, os.path.basename(src))
+            if done_dest is None:
+                done_dest = dest
+            if target_index.isfile(dest):
+                if kind == 'file':
+                    skipped = skipped + 1
+                event_log.emit('exists', n=n, src=src, dest=dest)
+                continue
+            # claimed, so a file of the same name later in the plan is not
+            # put on top of it
+            target_index.add(dest)
+            placements.append((kind, src, destdir, dest, size))
+            needed = needed + size
+        if placements:
+            todo.append((n, file, placements, done_dest))
+        else:
+            run_journal.record(file, done_dest)
+
+    writes = needed
+    if copy.mode == 'symlink':
+        writes = 0
+    elif copy.mode in ('hardlink', 'move') and \
+            os.stat(source).st_dev == os.stat(target).st_dev:
+        writes = 0
+    available = free_space(target)
+    log.info(str(len(todo)) + " files to place, " + str(needed) + " bytes, " +
+             str(writes) + " to write, " + str(available) + " bytes free in " +
+             target)
+    if writes > available:
+        log.critical("Not enough room in " + target + ": " + str(writes) +
+                     " bytes to write, " + str(available) + " free")
+        run_journal.close()
+        return None
+
+    copy_pool = None
+    if copy_threads > 1:
+        log.info("placing files with " + str(copy_threads) + " threads")
+        copy_pool = multiprocessing.pool.ThreadPool(copy_threads)
+    copies = pipeline.Window(copy_pool, copy_threads * 2)
+    place = copy.place
+    if latency:
+        place = pipeline.Delayed(place, latency)
+    ensured_dirs = set()
+
+    def finish(finished):
+        return finish_placements(finished, event_log, run_journal,
+                                 target_index)
+
+    copyCount = 0
+    exceptionCount = 0
+    bytes_done = 0
+    started = time.time()
+    reported = started
+    try:
+        for n, file, placements, done_dest in todo:
+            for kind, src, destdir, dest, size in placements:
+                ensure_dir(destdir, ensured_dirs)
+            copied, failed, done = finish(copies.submit(
+                place_files,
+                (place, [(p[1], p[2]) for p in placements]),
+                (n, file, placements, None, done_dest)))
+            copyCount = copyCount + copied
+            exceptionCount = exceptionCount + failed
+            bytes_done = bytes_done + done
+            if time.time() - reported >= _progress_every:
+                reported = time.time()
+                log.info(_progress(bytes_done, needed, reported - started))
+        copied, failed, done = finish(copies.drain())
+        copyCount = copyCount + copied
+        exceptionCount = exceptionCount + failed
+        bytes_done = bytes_done + done
+    finally:
+        if copy_pool:
+            copy_pool.terminate()
+            copy_pool.join()
+        run_journal.close()
+    log.info(_progress(bytes_done, needed, time.time() - started))
+    return copyCount, skipped, done_before, exceptionCount
+
+
+# createdirpath format fields, longest first, and how to render them
+_format_fields = {
+    'yyyy': lambda t: '%04d' % t.year,
+    'yy': lambda t: '%02d' % (t.year % 100),
+    'mmmm': lambda t: calendar.month_name[t.month],
+    'mmm': lambda t: calendar.month_abbr[t.month],
+    'mm': lambda t: '%02d' % t.month,
+    'm': lambda t: str(t.month),
+    'dddd': lambda t: calendar.day_name[t.weekday()],
+    'ddd': lambda t: calendar.day_abbr[t.weekday()],
+    'dd': lambda t: '%02d' % t.day,
+    'd': lambda t: str(t.day),
+    }
+_format_tokens = re.compile(r'yyyy|yy|m{1,4}|d{1,4}|[^md]')
+_compiled_formats = {}
+
+
+class DirFormat(object):
+    """A createdirpath format, parsed once into path components made of
+    literal text and date fields.
+
+    Rendered paths are remembered per calendar day, as a whole archive
+    usually only spans a few thousand of them.
+    """
+
+    def __init__(self, format):
+        self.format = format
+        self.components = []
+        for component in re.split(r'[/\\]', format):
+            tokens = []
+            for token in _format_tokens.findall(component):
+                field = _format_fields.get(token)
+                if field:
+                    tokens.append(field)
+                elif tokens and not callable(tokens[-1]):
+                    tokens[-1] = tokens[-1] + token
+                else:
+                    tokens.append(token)
+            # "/yyyy" or "yyyy//mm" must not turn into an absolute path
+            if tokens:
+                self.components.append(tokens)
+        self.memo = {}
+
+    def render(self, tstamp, target=None):
+        """Return the directory for tstamp, under target if given"""
+        key = (target, tstamp.year, tstamp.month, tstamp.day)
+        destpath = self.memo.get(key)
+        if destpath is None:
+            parts = [''.join([t(tstamp) if callable(t) else t for t in tokens])
+                     for tokens in self.components]
+            if target:
+                parts.insert(0, target)
+            destpath = parts and os.path.join(*parts) or ''
+            self.memo[key] = destpath
+        return destpath
+
 
-    return destpath
+def createdirpath(format, tstamp, target=None):
+    """Return target directory location based on format and date"""
+    compiled = _compiled_formats.get(format)
+    if compiled is None:
+        compiled = _compiled_formats[format] = DirFormat(format)
+    return compiled.render(tstamp, target)
 
 
 def main(argv):
-    global log
+    global log, event_log
     formats = ('jpg', 'avi', 'cr2', 'mov', 'mp4')
     default_format = 'yyyy/mmmm/yyyy_mm_dd'
     log = logging.getLogger()
@@ -280,27 +945,31 @@ def main(argv):
     localtime = time.localtime()
     timeString = time.strftime("%Y%m%d%H%M%S", localtime)
     debug = True
-    log_file = os.path.join(os.getcwd(), 'imagesorter.log.' + timeString)
-
-    if os.path.exists(os.path.dirname(log_file)):
-        fh = logging.FileHandler(log_file)
-    else:
-        raise "log directory does not exist (" + os.path.dirname(log_file) + ")"
-        sys.exit(1)
 
     log.addHandler(ch)
-    log.addHandler(fh)
 
     if debug:
         log.setLevel(logging.DEBUG)
     else:
         log.setLevel(logging.INFO)
 
+    command = None
+    if argv and argv[0] in ('plan', 'apply'):
+        command = argv[0]
+        argv = argv[1:]
+
     try:
         opts, args = getopt.getopt(argv,
-                                   "hvs:t:f:",
+                                   "hvs:t:f:j:c:m:drp:",
                                    ["help", "version", "source=",
-                                    "target=", "format="])
+                                    "target=", "format=", "jobs=",
+                                    "cache=", "rebuild-cache",
+                                    "copy-method=", "mode=", "dedup",
+                                    "resume", "walk-threads=",
+                                    "read-threads=", "copy-threads=",
+                                    "inject-latency=", "profile=",
+                                    "metrics-file=", "metrics-port=",
+                                    "log-dir=", "plan="])
     except getopt.GetoptError, err:
         # print help information and exit:
         print str(err) # will print something like "option -a not recognized"
@@ -315,6 +984,22 @@ def main(argv):
     _source = ""
     _target = ""
     _dir_format = ""
+    _jobs = 1
+    _cache_file = ""
+    _rebuild_cache = False
+    _copy_method = "auto"
+    _mode = "copy"
+    _dedup = False
+    _resume = False
+    _walk_threads = 1
+    _read_threads = 1
+    _copy_threads = None
+    _latency = 0
+    _profile_file = ""
+    _metrics_file = ""
+    _metrics_port = None
+    _log_dir = os.getcwd()
+    _plan_file = ""
 
     for o, a in opts:
         if o in ("-h", "--help"):
@@ -330,16 +1015,115 @@ def main(argv):
             _target = a
         elif o in ("-f", "--format"):
             _dir_format = a
+        elif o in ("-j", "--jobs"):
+            try:
+                _jobs = int(a)
+            except ValueError:
+                _jobs = 0
+            if _jobs < 1:
+                print "Jobs must be a positive number, got " + a
+                usage()
+                exit()
+        elif o in ("-c", "--cache"):
+            _cache_file = a
+        elif o == "--rebuild-cache":
+            _rebuild_cache = True
+        elif o == "--copy-method":
+            if a not in copier.methods:
+                print "Unknown copy method " + a
+                usage()
+                exit()
+            _copy_method = a
+        elif o in ("-m", "--mode"):
+            if a not in copier.modes:
+                print "Unknown mode " + a
+                usage()
+                exit()
+            _mode = a
+        elif o in ("-d", "--dedup"):
+            _dedup = True
+        elif o in ("-r", "--resume"):
+            _resume = True
+        elif o == "--walk-threads":
+            try:
+                _walk_threads = int(a)
+            except ValueError:
+                _walk_threads = 0
+            if _walk_threads < 1:
+                print "Walk threads must be a positive number, got " + a
+                usage()
+                exit()
+        elif o == "--read-threads":
+            try:
+                _read_threads = int(a)
+            except ValueError:
+                _read_threads = 0
+            if _read_threads < 1:
+                print "Read threads must be a positive number, got " + a
+                usage()
+                exit()
+        elif o == "--copy-threads":
+            try:
+                _copy_threads = int(a)
+            except ValueError:
+                _copy_threads = 0
+            if _copy_threads < 1:
+                print "Copy threads must be a positive number, got " + a
+                usage()
+                exit()
+        elif o == "--inject-latency":
+            try:
+                _latency = float(a) / 1000
+            except ValueError:
+                _latency = -1
+            if _latency < 0:
+                print "Latency must be a number of milliseconds, got " + a
+                usage()
+                exit()
+        elif o == "--profile":
+            _profile_file = a
+        elif o in ("-p", "--plan"):
+            _plan_file = a
+        elif o == "--log-dir":
+            _log_dir = a
+        elif o == "--metrics-file":
+            _metrics_file = a
+        elif o == "--metrics-port":
+            try:
+                _metrics_port = int(a)
+            except ValueError:
+                print "Metrics port must be a number, got " + a
+                usage()
+                exit()
         else:
             assert False, "unhandled option"
 
     if not _dir_format:
         _dir_format = default_format
 
+    if command and not _plan_file:
+        print "imagesorter " + command + " needs a plan file (-p)"
+        usage()
+        exit()
+
+    if command == 'apply':
+        try:
+            header, entries = plan.read(_plan_file)
+        except (IOError, plan.PlanError), err:
+            print "Can not read plan: " + str(err)
+            exit()
+        _source = _source or header['source']
+        _target = _target or header['target']
+
     if not _source:
         _source = os.getcwd()
 
-    if not _target:
+    if _rebuild_cache and not _cache_file:
+        print "--rebuild-cache needs a cache file (-c)"
+        usage()
+        exit()
+
+    if not _target and command != 'plan':
         print "No target location provided!, Where will I copy this?"
         usage()
         exit()
@@ -349,142 +1133,318 @@ def main(argv):
         usage()
         exit()
 
-    if not os.path.exists(_target):
+    # a plan may be for a target on another machine
+    if command != 'plan' and not os.path.exists(_target):
         print "Target " + _target + " is not a directory!"
         usage()
         exit()
 
+    if not os.path.isdir(_log_dir):
+        print "Log directory " + _log_dir + " is not a directory!"
+        usage()
+        exit()
+
+    # before anything is set up, so a port that is taken does not leave a
+    # journal or event log behind
+    metrics_server = None
+    if _metrics_port is not None and not command:
+        try:
+            metrics_server = metrics.listen(_metrics_port)
+        except socket.error, err:
+            print "Can not serve metrics on port " + str(_metrics_port) + ": " + str(err)
+            exit()
+
+    log_file = os.path.join(_log_dir, 'imagesorter.' + timeString + '.jsonl')
+    event_log = events.EventLog(log_file)
+    # like logging.shutdown, so the last events make it even after a crash
+    atexit.register(event_log.close)
+    log.addHandler(events.EventHandler(event_log))
+    # before the --jobs workers are forked
+    backend_stats.collect()
+
+    log.info("logging events to " + log_file)
+
+    if command == 'plan':
+        metadata_cache = None
+        if _cache_file:
+            log.info("using metadata cache " + _cache_file)
+            metadata_cache = cache.MetadataCache(_cache_file, _rebuild_cache)
+        log.info("Planning how to sort " + _source + " into " + _dir_format)
+        writer = make_plan(_plan_file, _source, _target, _dir_format, formats,
+                           event_log, _jobs, _read_threads, _walk_threads,
+                           metadata_cache, _latency)
+        backend_stats.finish()
+        log.info("Plan written to " + _plan_file + ": " + str(writer.files) + " files, " + str(writer.bytes) + " bytes")
+        if backend_stats.counts:
+            log.info("Metadata backends: " + backend_stats.summary())
+        return
+
+    if command == 'apply':
+        log.info("Applying plan " + _plan_file + " from " + _source + " to target " + _target)
+        copy = copier.Copier(_copy_method, _mode)
+        counts = apply_plan(entries, _source, _target, copy, event_log,
+                            _copy_threads or 4, _resume, _latency)
+        if counts is None:
+            sys.exit(1)
+        copyCount, skipCount, doneCount, exceptionCount = counts
+        log.info("Apply Complete")
+        if _resume:
+            log.info("Files skipped as done before: " + str(doneCount))
+        log.info("Files copied: " + str(copyCount))
+        log.info("Files skipped as they exist in destination: " + str(skipCount))
+        log.info("Exceptions while copying: " + str(exceptionCount))
+        log.info("Copy methods used: " + copy.summary())
+        return
+
     log.info("Processing and sorting " + _source + " to target " + _target)
 
-    fileList = []
-    for root, dirs, files in os.walk(_source):
-        for name in files:
-            filename = os.path.join(root, name)
-            if filename.lower().endswith(formats):
-                fileList.append(filename)
+    profiler = None
+    unprofiled = {}
+    if _profile_file:
+        profiler = instrument.Profiler()
+        profiler.time_handlers(log)
+        # the pool workers are forked later, so they get the timed ones too
+        for name, stage in _profiled:
+            unprofiled[name] = globals()[name]
+            globals()[name] = profiler.timed(stage, unprofiled[name])
 
     problems_loc = os.path.join(_target, "exif_problems")
-    try:
-        os.makedirs(problems_loc)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST:
-            pass
-        else:
-            raise
-    to_be_processed = len(fileList)
-    log.info("images to be processed -> " + str(to_be_processed))
+    ensured_dirs = set()
+    target_index = listing.TargetIndex()
+    ensure_dir(problems_loc, ensured_dirs)
 
     processCount = 0
     nocreatedateCount = 0
     copyCount = 0
     skipCount = 0
+    dupCount = 0
     exceptionCount = 0
     avionlycount = 0
     avithmcount = 0
     has_avi = False
-    for file in fileList:
-        processCount = processCount + 1
-        filename = os.path.basename(file)
-        orig_path = os.path.dirname(os.path.abspath(file))
-        has_thm = False
-        is_video_file = False
-        if filename.lower().endswith('avi'):
-            is_video_file = True
-            has_thm, thm_filename, thm_fullpath = has_thm_file(file)
-        if filename.lower().endswith(('mov', 'mp4')):
-            is_video_file = True
+    copy = copier.Copier(_copy_method, _mode)
+
+    content_index = None
+    if _dedup:
+        index_file = os.path.join(_target, ".imagesorter", "content.db")
+        log.info("indexing content of " + _target)
+        # the source when it is inside the target, or every file in it
+        # would be a duplicate of itself
+        content_index = dedup.ContentIndex(index_file, _target,
+                                           [problems_loc, _source])
+        content_index.refresh()
+
+    metadata_cache = None
+    if _cache_file:
+        log.info("using metadata cache " + _cache_file)
+        metadata_cache = cache.MetadataCache(_cache_file, _rebuild_cache)
+
+    journal_file = os.path.join(_target, ".imagesorter", "journal")
+    run_journal = journal.Journal(journal_file, _resume)
+    if _resume:
+        log.info("resuming, " + str(len(run_journal.done)) + " files already done")
+
+    walker = pipeline.FileWalker(_source, formats, _target, run_journal.done,
+                                 _sidecars, stat=metadata_cache is not None,
+                                 threads=_walk_threads)
+    if _walk_threads > 1:
+        log.info("listing source directories with " + str(_walk_threads) + " threads")
+    if profiler:
+        walker.scan = profiler.timed('walk', walker.scan)
+        run_journal.record = profiler.timed('journal', run_journal.record)
+        if metadata_cache:
+            metadata_cache.get = profiler.timed('cache', metadata_cache.get)
+        if content_index:
+            content_index.find = profiler.timed('dedup', content_index.find)
+    # stage -> queue of the items waiting for it
+    stage_queues = {}
+    files = pipeline.bounded(walker, _queue_size, 'extract', stage_queues)
+    pool, read_slots, chunksize = _extraction_pool(_jobs, _read_threads)
+    results = extract_create_dates(files, metadata_cache, pool, read_slots,
+                                   chunksize, _latency)
+    results = pipeline.bounded(results, _queue_size, 'place', stage_queues)
+
+    _copy_threads = _copy_threads or 1
+    copy_pool = None
+    if _copy_threads > 1:
+        log.info("placing files with " + str(_copy_threads) + " threads")
+        copy_pool = multiprocessing.pool.ThreadPool(_copy_threads)
+    copies = pipeline.Window(copy_pool, _copy_threads * 2)
+    live = None
+    if _metrics_file or _metrics_port is not None:
+        live = metrics.Metrics(walker, copy, stage_queues, copies,
+                               _metrics_file or None, metrics_server)
+        if _metrics_port is not None:
+            log.info("serving metrics on http://127.0.0.1:" + str(_metrics_port) + "/metrics")
+    place = copy.place
+    if _latency:
+        log.info("adding " + str(_latency) + " seconds to every read and copy")
+        place = pipeline.Delayed(place, _latency)
+
+    def finish(finished):
+        return finish_placements(finished, event_log, run_journal,
+                                 target_index, content_index)
 
-        create_date = None
-        if not is_video_file:
-            exif = get_exif_data(file)
-            create_date = get_create_date(exif)
-        else:
-            if is_video_file and has_thm:
+    try:
+        for file, create_date, thm_filename, thm_fullpath, date_source in results:
+            processCount = processCount + 1
+            if live:
+                live.update(processed=processCount, copied=copyCount,
+                            skipped=skipCount, duplicates=dupCount,
+                            no_date=nocreatedateCount,
+                            exceptions=exceptionCount)
+            filename = os.path.basename(file)
+            orig_path = os.path.dirname(os.path.abspath(file))
+            has_thm = thm_fullpath is not None
+            if date_source == 'thm':
                 avithmcount = avithmcount + 1
-                exif = get_exif_data(thm_fullpath)
-                create_date = get_create_date(exif)
-            else:
+            elif date_source == 'hachoir':
                 avionlycount = avionlycount + 1
-                create_date = get_hachoir_create_date(file)
-
-        if create_date:
-            """
-            year_str = str(create_date.year)
-            month = create_date.month
-            month_name = calendar.month_name[month]
-            day = create_date.day
-            if month < 10:
-                month_str = '0'+str(month)
-            else:
-                month_str = str(month)
-            if day < 10:
-                day_str = '0'+str(day)
-            else:
-                day_str = str(day)
-
-            folder_name = year_str + "_" + month_str + "_" + day_str
-            destpath = os.path.join(_target, year_str, month_name, folder_name)
-            """
-            destpath = createdirpath(_dir_format, create_date, _target)
-            try:
-                os.makedirs(destpath)
-            except OSError as exc:
-                if exc.errno == errno.EEXIST:
-                    pass
+            if profiler:
+                profiler.count('date from ' + date_source if create_date
+                               else 'no date')
+            # where the file ended up, once we are done with it for good
+            done_dest = None
+            # (kind, source, directory, destination, size) of what to put in
+            # place, the size is not needed
+            placements = []
+            digest = None
+
+            if create_date:
+                """
+                year_str = str(create_date.year)
+                month = create_date.month
+                month_name = calendar.month_name[month]
+                day = create_date.day
+                if month < 10:
+                    month_str = '0'+str(month)
                 else:
-                    raise
-            dest_file = os.path.join(destpath, filename)
-            try:
-                if not os.path.isfile(dest_file):
-                    shutil.copy2(file, destpath)
-                    copyCount = copyCount + 1
-                    log.info("(" + str(processCount) + "/" + str(to_be_processed) + ") " + filename + " => " + destpath)
+                    month_str = str(month)
+                if day < 10:
+                    day_str = '0'+str(day)
                 else:
-                    skipCount = skipCount + 1
-                    log.error("(" + str(processCount) + "/" + str(to_be_processed) + ") " + file + " not copied as already exists in destination")
-            except OSError as exc:
-                exceptionCount = exceptionCount + 1
-                log.critical("(" + str(processCount) + "/" + str(to_be_processed) + ") " + "Skipped " + file + " due to exception!")
-                pass
-            if has_thm:
-                dest_thmfile = os.path.join(destpath, thm_filename)
+                    day_str = str(day)
+
+                folder_name = year_str + "_" + month_str + "_" + day_str
+                destpath = os.path.join(_target, year_str, month_name, folder_name)
+                """
+                destpath = createdirpath(_dir_format, create_date, _target)
+                if ensure_dir(destpath, ensured_dirs):
+                    target_index.add_dir(destpath)
+                dest_file = os.path.join(destpath, filename)
+                duplicate = None
                 try:
-                    if not os.path.isfile(dest_thmfile):
-                        shutil.copy2(thm_fullpath, destpath)
-                        #copyCount = copyCount + 1
-                        log.info("(" + str(processCount) + "/" + str(to_be_processed) + ") " + thm_filename + " => " + destpath)
+                    if target_index.isfile(dest_file):
+                        skipCount = skipCount + 1
+                        event_log.emit('exists', n=processCount, src=file,
+                                       dest=dest_file)
+                        done_dest = dest_file
+                    else:
+                        if content_index:
+                            duplicate, digest = content_index.find(file)
+                        if duplicate:
+                            dupCount = dupCount + 1
+                            event_log.emit('duplicate', n=processCount,
+                                           src=file, dest=duplicate)
+                            done_dest = duplicate
+                        else:
+                            placements.append(('file', file, destpath,
+                                               dest_file, None))
+                            done_dest = dest_file
+                except (IOError, OSError) as exc:
+                    exceptionCount = exceptionCount + 1
+                    event_log.emit('failed', level='error', n=processCount,
+                                   src=file, error=str(exc))
+                if has_thm and not duplicate:
+                    dest_thmfile = os.path.join(destpath, thm_filename)
+                    if not target_index.isfile(dest_thmfile):
+                        placements.append(('thm', thm_fullpath, destpath,
+                                           dest_thmfile, None))
                     else:
                         #skipCount = skipCount + 1
                         orig_thm_file = os.path.join(orig_path, thm_filename)
-                        log.error("(" + str(processCount) + "/" + str(to_be_processed) + ") " + orig_thm_file + " not copied as already exists in destination")
-                except OSError as exc:
-                    #exceptionCount = exceptionCount + 1
-                    log.critical("(" + str(processCount) + "/" + str(to_be_processed) + ") " + "Skipped " + file + " due to exception!")
-                    pass
-
-        else:
-            nocreatedateCount = nocreatedateCount + 1
-            log.error("(" + str(processCount) + "/" + str(to_be_processed) + ") " + "Skipped " + file + " due to no create date!")
-            new_error_dest = os.path.join(problems_loc, orig_path[1:])
-            try:
-                os.makedirs(new_error_dest)
-            except OSError as exc:
-                if exc.errno == errno.EEXIST:
-                    pass
-                else:
-                    raise
-            new_dest_file = os.path.join(new_error_dest, filename)
-            try:
-                if not os.path.isfile(new_dest_file):
-                    shutil.copy2(file, new_error_dest)
-            except:
-                pass
+                        event_log.emit('exists', n=processCount,
+                                       src=orig_thm_file, dest=dest_thmfile)
 
+            else:
+                nocreatedateCount = nocreatedateCount + 1
+                event_log.emit('no_date', n=processCount, src=file)
+                new_error_dest = os.path.join(_target, problem_dir(file))
+                if ensure_dir(new_error_dest, ensured_dirs):
+                    target_index.add_dir(new_error_dest)
+                new_dest_file = os.path.join(new_error_dest, filename)
+                if not target_index.isfile(new_dest_file):
+                    placements.append(('problem', file, new_error_dest,
+                                       new_dest_file, None))
+                done_dest = new_dest_file
+
+            if not placements:
+                if done_dest:
+                    run_journal.record(file, done_dest)
+                continue
+            # claim the destinations now, so a file with the same name that
+            # comes along while these are in flight is not put on top
+            for kind, src, destdir, dest, size in placements:
+                target_index.add(dest)
+            copied, failed, done = finish(copies.submit(
+                place_files,
+                (place, [(p[1], p[2]) for p in placements]),
+                (processCount, file, placements, digest, done_dest)))
+            copyCount = copyCount + copied
+            exceptionCount = exceptionCount + failed
+        copied, failed, done = finish(copies.drain())
+        copyCount = copyCount + copied
+        exceptionCount = exceptionCount + failed
+    finally:
+        if pool:
+            # every result has been consumed by now, unless we are
+            # bailing out on an error, so there is nothing left to wait for
+            pool.terminate()
+            pool.join()
+        if copy_pool:
+            copy_pool.terminate()
+            copy_pool.join()
+        if metadata_cache:
+            metadata_cache.close()
+        if content_index:
+            content_index.close()
+        run_journal.close()
+        globals().update(unprofiled)
+        if live:
+            live.update(processed=processCount, copied=copyCount,
+                        skipped=skipCount, duplicates=dupCount,
+                        no_date=nocreatedateCount, exceptions=exceptionCount)
+            live.close()
+
+    log.info("images processed -> " + str(processCount))
+    if _resume:
+        log.info("images skipped as done before -> " + str(walker.excluded))
+    if metadata_cache:
+        log.info("create dates found in cache: " + str(metadata_cache.hits) + ", parsed: " + str(metadata_cache.misses))
     log.info("Copy Complete")
     log.info("Files not sorted because of no create date exif data: " + str(nocreatedateCount))
     log.info("Files copied: " + str(copyCount))
     log.info("Files skipped as they exist in destination: " + str(skipCount))
+    if content_index:
+        log.info("Files skipped as their content exists in destination: " + str(dupCount) + " (" + str(content_index.bytes_saved) + " bytes saved)")
     log.info("Exceptions while copying: " + str(exceptionCount))
+    log.info("Copy methods used: " + copy.summary())
+    backend_stats.finish()
+    if backend_stats.counts:
+        log.info("Metadata backends: " + backend_stats.summary())
+
+    if profiler:
+        profiler.finish()
+        extra = {'files': processCount, 'copy_methods': copy.counts,
+                 'copy_bytes': copy.bytes, 'backends': backend_stats.counts}
+        if metadata_cache:
+            extra['cache'] = {'hits': metadata_cache.hits,
+                              'misses': metadata_cache.misses}
+        report = profiler.write(_profile_file, extra)
+        for name, stage in sorted(report['stages'].items()):
+            log.info("profile " + name + ": " + str(stage['count']) + " calls, " +
+                     "%.3fs wall, %.3fs cpu" % (stage['wall'], stage['cpu']))
+        log.info("profile written to " + _profile_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+'''
+Opt-in instrumentation for imagesorter, behind --profile.
+
+main() wraps the functions of every stage in Profiler.timed when profiling
+is asked for, so a run without --profile calls the plain functions and pays
+nothing for it. Every call then adds its wall and CPU time to the stage it
+belongs to. Stages nest: extract includes exif, pil and hachoir.
+
+CPU time is the time of the calling thread, where the platform can tell,
+so stages running in threads at the same time don't count each other's
+work. Calls in --jobs worker processes send their samples to the main
+process over a pipe.
+
+The report is JSON: per stage the number of calls, total and longest wall
+time, total CPU time and a histogram of wall times in power of two buckets
+of microseconds; plus counts, peak RSS of the process and of its workers,
+and the top allocators when tracemalloc is available (Python 3.4+, or 2.7
+with pytracemalloc).
+'''
+import os
+import json
+import time
+import ctypes
+import ctypes.util
+import functools
+import threading
+import multiprocessing.queues
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# allocators listed in the report
+_top_allocators = 20
+# from linux/time.h
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+except (OSError, AttributeError):
+    _clock_gettime = None
+
+
+def thread_cpu():
+    """Return the CPU time of the calling thread in seconds, or of the
+    process where there is no way to tell"""
+    if _clock_gettime is not None:
+        ts = _timespec()
+        if _clock_gettime(_CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) == 0:
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    return time.clock()
+
+
+class Stage(object):
+    """Times of the calls made in one stage"""
+    __slots__ = ('count', 'wall', 'cpu', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max = 0.0
+        # n -> calls that took at least 2**(n-1) and less than 2**n us
+        self.buckets = {}
+
+    def add(self, wall, cpu):
+        self.count = self.count + 1
+        self.wall = self.wall + wall
+        self.cpu = self.cpu + cpu
+        if wall > self.max:
+            self.max = wall
+        bucket = int(wall * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def report(self):
+        return {'count': self.count, 'wall': self.wall, 'cpu': self.cpu,
+                'max': self.max,
+                'histogram': [[2 ** n, self.buckets[n]]
+                              for n in sorted(self.buckets)]}
+
+
+class Profiler(object):
+    """Collects the stage times and counts of a run"""
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.pid = os.getpid()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # samples from worker processes, and a thread to take them in
+        self._queue = multiprocessing.queues.SimpleQueue()
+        self._drained = threading.Event()
+        drainer = threading.Thread(target=self._drain)
+        drainer.daemon = True
+        drainer.start()
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+    def _drain(self):
+        while True:
+            sample = self._queue.get()
+            if sample is None:
+                self._drained.set()
+                return
+            self._add(*sample)
+
+    def _add(self, stage, wall, cpu):
+        with self._lock:
+            times = self.stages.get(stage)
+            if times is None:
+                times = self.stages[stage] = Stage()
+            times.add(wall, cpu)
+
+    def record(self, stage, wall, cpu):
+        """Add a call of wall and cpu seconds to stage"""
+        if os.getpid() != self.pid:
+            self._queue.put((stage, wall, cpu))
+        else:
+            self._add(stage, wall, cpu)
+
+    def count(self, name, n=1):
+        """Add n to the count of name. Only in the main process"""
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def timed(self, stage, func):
+        """Return func, recording every call to it in stage"""
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            wall = time.time()
+            cpu = thread_cpu()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.time() - wall, thread_cpu() - cpu)
+        return timed_func
+
+    def time_handlers(self, logger, stage='log'):
+        """Record the time the handlers of logger take in stage"""
+        for handler in logger.handlers:
+            handler.handle = self.timed(stage, handler.handle)
+
+    def finish(self):
+        """Wait for the samples the worker processes sent. Call when the
+        workers are done"""
+        self._queue.put(None)
+        self._drained.wait()
+
+    def report(self, extra=None):
+        """Return the report as a dict, with the items of extra added"""
+        times = os.times()
+        result = {'wall': time.time() - self.started,
+                  'cpu': {'user': times[0], 'system': times[1],
+                          'children_user': times[2],
+                          'children_system': times[3]},
+                  'stages': dict((name, stage.report()) for name, stage
+                                 in self.stages.items()),
+                  'counts': self.counts}
+        if resource is not None:
+            # kilobytes on Linux
+            result['peak_rss'] = {
+                'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'children':
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+        if tracemalloc is not None:
+            stats = tracemalloc.take_snapshot().statistics('lineno')
+            result['allocators'] = [
+                {'where': '%s:%d' % (stat.traceback[0].filename,
+                                     stat.traceback[0].lineno),
+                 'size': stat.size, 'count': stat.count}
+                for stat in stats[:_top_allocators]]
+        if extra:
+            result.update(extra)
+        return result
+
+    def write(self, filename, extra=None):
+        """Write the report to filename as JSON, and return it"""
+        result = self.report(extra)
+        with open(filename, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        return result
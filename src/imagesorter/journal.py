@@ -0,0 +1,75 @@
+'''
+Processing journal, so an interrupted run can be resumed.
+
+Every source file main() is done with is appended to the journal as a JSON
+line [source, destination]. Paths are byte strings that need not be UTF-8,
+so they are written as latin-1, which maps every byte to a character and
+back. Lines are fsynced in batches, so after a crash
+at most the last batch is lost, and those files are simply processed again.
+With --resume the files in the journal are skipped without being looked at.
+'''
+import os
+import json
+import time
+
+
+_sync_every = 100
+_sync_seconds = 5
+# how paths are turned into JSON strings and back, losslessly
+_path_encoding = 'latin-1'
+
+
+class Journal(object):
+    """Append-only record of the source files a run is done with"""
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        # absolute paths of the source files done by earlier runs
+        self.done = set()
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if resume and os.path.exists(filename):
+            self.load()
+            self.f = open(filename, 'a')
+            # a crash can leave half a line behind, don't append to it
+            if self.f.tell() and not self._ends_with_newline():
+                self.f.write('\n')
+        else:
+            self.f = open(filename, 'w')
+        self._pending = 0
+        self._synced = time.time()
+
+    def _ends_with_newline(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == '\n'
+
+    def load(self):
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    source, dest = json.loads(line)
+                except ValueError:
+                    # the line being written when the run died
+                    continue
+                self.done.add(source.encode(_path_encoding))
+
+    def record(self, source, dest):
+        """Remember that source is done, it went to dest"""
+        self.f.write(json.dumps([os.path.abspath(source), dest],
+                                encoding=_path_encoding) + '\n')
+        self._pending = self._pending + 1
+        if (self._pending >= _sync_every or
+                time.time() - self._synced >= _sync_seconds):
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._pending = 0
+        self._synced = time.time()
+
+    def close(self):
+        self.sync()
+        self.f.close()
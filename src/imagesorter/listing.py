@@ -0,0 +1,101 @@
+'''
+Directory listings for imagesorter.
+
+Checking os.path.isfile for every file about to be copied is a round trip
+per file on a remote target. TargetIndex lists each destination directory
+once and answers from the listing after that. Listings are kept for the
+whole run: they are only file names, a few per picture, while listing a
+directory again costs as much as the first time. The source walk uses the
+same listings, via scan(), to find files and their sidecars.
+
+os.scandir is used when there is one (Python 3.5+, or the scandir package
+on Python 2), as it knows which entries are files without a stat call per
+entry. Otherwise os.listdir is used and every entry is taken for a file.
+'''
+import os
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class _Entry(object):
+    """Stand-in for os.DirEntry when there is no scandir. Every question
+    costs a stat, as it does for os.walk"""
+    __slots__ = ('name', 'path')
+
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def scan(dirname):
+    """Return the entries of dirname, like list(os.scandir(dirname))"""
+    if scandir is None:
+        return [_Entry(dirname, name) for name in os.listdir(dirname)]
+    return list(scandir(dirname))
+
+
+def list_files(dirname):
+    """Return the set of names of the files in dirname"""
+    if scandir is None:
+        return set(os.listdir(dirname))
+    return set(entry.name for entry in scandir(dirname) if entry.is_file())
+
+
+class TargetIndex(object):
+    """Answers isfile for paths in the target from directory listings"""
+
+    def __init__(self):
+        # directory -> set of file names
+        self.dirs = {}
+        self.listed = 0
+
+    def _files(self, dirname):
+        files = self.dirs.get(dirname)
+        if files is None:
+            try:
+                files = list_files(dirname)
+            except OSError:
+                files = set()
+            self.listed = self.listed + 1
+            self.dirs[dirname] = files
+        return files
+
+    def isfile(self, path):
+        """Like os.path.isfile, for paths in the target"""
+        dirname, name = os.path.split(path)
+        return name in self._files(dirname)
+
+    def add(self, path):
+        """Note that a file was just placed at path"""
+        dirname, name = os.path.split(path)
+        files = self.dirs.get(dirname)
+        if files is not None:
+            files.add(name)
+
+    def discard(self, path):
+        """Note that there is no file at path after all"""
+        dirname, name = os.path.split(path)
+        files = self.dirs.get(dirname)
+        if files is not None:
+            files.discard(name)
+
+    def add_dir(self, dirname):
+        """Note that dirname was just created, so it is empty"""
+        self.dirs[dirname] = set()
@@ -0,0 +1,215 @@
+'''
+Live metrics of a running sort.
+
+Metrics samples the counters main() keeps, the bytes the Copier copied and
+the depths of the queues between the stages every few seconds, works out
+rates over the last minute and an ETA, and publishes them in the
+Prometheus text format:
+
+    textfile  rewritten in place every interval, for the textfile
+              collector of node_exporter, or just to cat
+    port      served at http://127.0.0.1:port/metrics, and as JSON at
+              /status
+
+imagesorter_last_progress_timestamp_seconds is when a file was last done
+with, so a stalled run shows up as that falling behind time().
+'''
+import os
+import json
+import time
+import threading
+import collections
+import BaseHTTPServer
+
+
+# seconds between samples
+_interval = 5
+# seconds the rates are averaged over
+_window = 60
+
+# counter -> help text. main() keeps these
+counters = collections.OrderedDict([
+    ('processed', 'Files processed'),
+    ('copied', 'Files copied into the target'),
+    ('skipped', 'Files skipped as they exist in the target'),
+    ('duplicates', 'Files skipped as their content exists in the target'),
+    ('no_date', 'Files without a create date'),
+    ('exceptions', 'Files that failed to copy'),
+])
+
+
+class Metrics(object):
+    """Publishes the progress of a run, from a thread of its own.
+
+    walker is the pipeline.FileWalker of the run, copier its Copier and
+    queues the stage name -> Queue of the queues between the stages.
+    copies, if given, is the pipeline.Window of the copies in flight, and
+    server the HTTP server from listen() to serve the metrics on.
+    """
+
+    def __init__(self, walker, copier, queues, copies=None, textfile=None,
+                 server=None, interval=_interval):
+        self.walker = walker
+        self.copier = copier
+        self.queues = queues
+        self.copies = copies
+        self.textfile = textfile
+        self.interval = interval
+        self.counters = dict((name, 0) for name in counters)
+        self.started = time.time()
+        self.progressed = self.started
+        # (time, processed, bytes) of the samples in the window
+        self.samples = collections.deque()
+        self.text = ''
+        self.status = {}
+        self._stop = threading.Event()
+        self.server = server
+        if server is not None:
+            server.RequestHandlerClass = _handler(self)
+            serving = threading.Thread(target=server.serve_forever)
+            serving.daemon = True
+            serving.start()
+        self.sample()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, **values):
+        """Set counters of the run, e.g. update(processed=10)"""
+        if values.get('processed', 0) != self.counters['processed']:
+            self.progressed = time.time()
+        self.counters.update(values)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Take a sample and publish it"""
+        now = time.time()
+        processed = self.counters['processed']
+        copied_bytes = sum(self.copier.bytes.values())
+        self.samples.append((now, processed, copied_bytes))
+        while now - self.samples[0][0] > _window and len(self.samples) > 2:
+            self.samples.popleft()
+        then, processed_then, bytes_then = self.samples[0]
+        elapsed = now - then
+        files_rate = 0.0
+        bytes_rate = 0.0
+        if elapsed > 0:
+            files_rate = (processed - processed_then) / elapsed
+            bytes_rate = (copied_bytes - bytes_then) / elapsed
+        found = self.walker.found
+        eta = None
+        if self.walker.finished and files_rate > 0:
+            eta = (found - processed) / files_rate
+        status = dict(self.counters)
+        status.update({
+            'found': found,
+            'walk_finished': self.walker.finished,
+            'bytes_copied': copied_bytes,
+            'files_per_second': files_rate,
+            'bytes_per_second': bytes_rate,
+            'eta_seconds': eta,
+            'queue_depth': dict((stage, queue.qsize()) for stage, queue
+                                in self.queues.items()),
+            'started': self.started,
+            'last_progress': self.progressed,
+        })
+        if self.copies is not None:
+            status['queue_depth']['copy'] = len(self.copies.pending)
+        self.status = status
+        self.text = render(status)
+        if self.textfile:
+            self._write(self.text)
+
+    def _write(self, text):
+        # rename, so readers never see half a file
+        tmp = self.textfile + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, self.textfile)
+
+    def close(self):
+        """Publish the final numbers and stop"""
+        self._stop.set()
+        self.thread.join()
+        self.sample()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _metric(lines, name, kind, description, value):
+    if value is None:
+        value = 'NaN'
+    lines.append('# HELP imagesorter_%s %s' % (name, description))
+    lines.append('# TYPE imagesorter_%s %s' % (name, kind))
+    lines.append('imagesorter_%s %s' % (name, value))
+
+
+def render(status):
+    """Return status in the Prometheus text format"""
+    lines = []
+    for name, description in counters.items():
+        _metric(lines, name + '_total', 'counter', description, status[name])
+    _metric(lines, 'bytes_copied_total', 'counter', 'Bytes copied',
+            status['bytes_copied'])
+    _metric(lines, 'files_found', 'gauge', 'Files found in the source so far',
+            status['found'])
+    _metric(lines, 'walk_finished', 'gauge',
+            '1 once the whole source was walked',
+            int(status['walk_finished']))
+    _metric(lines, 'files_per_second', 'gauge',
+            'Files processed per second over the last minute',
+            '%.3f' % status['files_per_second'])
+    _metric(lines, 'bytes_per_second', 'gauge',
+            'Bytes copied per second over the last minute',
+            '%.1f' % status['bytes_per_second'])
+    eta = status['eta_seconds']
+    _metric(lines, 'eta_seconds', 'gauge',
+            'Seconds until all files are processed, NaN while unknown',
+            eta is not None and '%.0f' % eta or None)
+    lines.append('# HELP imagesorter_queue_depth Items waiting between '
+                 'stages')
+    lines.append('# TYPE imagesorter_queue_depth gauge')
+    for stage, depth in sorted(status['queue_depth'].items()):
+        lines.append('imagesorter_queue_depth{stage="%s"} %d' %
+                     (stage, depth))
+    _metric(lines, 'start_timestamp_seconds', 'gauge',
+            'When the run started', '%.0f' % status['started'])
+    _metric(lines, 'last_progress_timestamp_seconds', 'gauge',
+            'When a file was last processed',
+            '%.0f' % status['last_progress'])
+    return '\n'.join(lines) + '\n'
+
+
+def listen(port):
+    """Return an HTTP server listening on 127.0.0.1:port, for Metrics to
+    serve on. Raises socket.error when the port is taken"""
+    return BaseHTTPServer.HTTPServer(('127.0.0.1', port),
+                                     BaseHTTPServer.BaseHTTPRequestHandler)
+
+
+def _handler(metrics):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics.text
+                kind = 'text/plain; version=0.0.4'
+            elif self.path == '/status':
+                body = json.dumps(metrics.status, indent=2, sort_keys=True)
+                kind = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # not into the log of the run
+            pass
+    return Handler
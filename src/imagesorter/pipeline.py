@@ -0,0 +1,335 @@
+'''
+Streaming stages for imagesorter.
+
+main() used to walk the whole source tree into a list before copying the
+first file. These helpers let it run walk -> extract -> copy as a chain of
+generators instead, with a bounded queue between the stages so memory stays
+flat no matter how big the tree is.
+'''
+import os
+import sys
+import time
+import Queue
+import threading
+import collections
+
+import listing
+
+
+_done = object()
+# directory listings the walker threads may get ahead of the consumer
+_walk_backlog = 1000
+
+
+class FileWalker(object):
+    """Walk source yielding the files that end with one of formats.
+
+    Counts the files as it goes so the copy stage can report progress while
+    the walk is still running. The walk runs while files are being placed,
+    so the skip directory (the target, when it is inside the source) is left
+    out rather than sorting what was just sorted. Files whose absolute path
+    is in exclude are left out too, and only counted in excluded.
+
+    Each file comes out as (path, sidecars, st). sidecars maps the lower
+    case extension of a file to the extensions of the files that go with it,
+    e.g. {'avi': ('thm',)}, and the names of those found next to it are
+    given in that order. They are picked from the directory listing without
+    regard to case, so pairing costs no stat calls. st is the stat of the
+    file taken from its directory entry if stat is set, else None.
+
+    With threads > 1 that many threads scan directories at the same time,
+    taking them from a shared queue, which hides the latency of listing
+    directories on network filesystems. Files then come out as soon as their
+    directory is scanned, in no particular order.
+    """
+
+    def __init__(self, source, formats, skip=None, exclude=(), sidecars=None,
+                 stat=False, threads=1):
+        self.source = source
+        self.formats = formats
+        self.skip = skip and os.path.realpath(skip)
+        self.exclude = exclude
+        self.sidecars = sidecars or {}
+        self.stat = stat
+        self.threads = threads
+        self.found = 0
+        self.excluded = 0
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def _is_skipped(self, entry):
+        # realpath costs a readlink per path component, so only ask it
+        # about directories that have the right name
+        return (self.skip and entry.name == os.path.basename(self.skip) and
+                os.path.realpath(entry.path) == self.skip)
+
+    def _sidecar_exts(self, name):
+        return self.sidecars.get(os.path.splitext(name.lower())[1][1:])
+
+    def scan(self, dirname):
+        """Return (items, subdirs), the items for the files directly in
+        dirname and the subdirectories of dirname to walk"""
+        try:
+            entries = listing.scan(dirname)
+        except OSError:
+            # gone or unreadable, like os.walk
+            return [], []
+        files = []
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # os.walk lists symlinks to directories but does not follow
+                if not entry.is_symlink() and not self._is_skipped(entry):
+                    subdirs.append(entry.path)
+            else:
+                files.append(entry)
+        by_name = None
+        items = []
+        excluded = 0
+        for entry in files:
+            name = entry.name
+            if not name.lower().endswith(self.formats):
+                continue
+            if self.exclude and os.path.abspath(entry.path) in self.exclude:
+                excluded = excluded + 1
+                continue
+            sidecars = ()
+            exts = self.sidecars and self._sidecar_exts(name)
+            if exts:
+                if by_name is None:
+                    # lower case name -> name. Upper case sorts first, so
+                    # comes last here and wins, as .THM did over .thm
+                    by_name = dict((e.name.lower(), e.name) for e in
+                                   sorted(files, key=lambda e: e.name,
+                                          reverse=True))
+                stem = os.path.splitext(name.lower())[0]
+                sidecars = tuple(by_name[stem + '.' + ext] for ext in exts
+                                 if stem + '.' + ext in by_name)
+            st = None
+            if self.stat:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    pass
+            items.append((entry.path, sidecars, st))
+        if excluded:
+            with self._lock:
+                self.excluded = self.excluded + excluded
+        return items, subdirs
+
+    def __iter__(self):
+        if self.threads > 1:
+            walk = self._walk_threaded()
+        else:
+            walk = self._walk()
+        for items in walk:
+            for item in items:
+                self.found = self.found + 1
+                yield item
+        self.finished = True
+
+    def _walk(self):
+        # top down and depth first, in the order os.walk goes
+        pending = [self.source]
+        while pending:
+            items, subdirs = self.scan(pending.pop())
+            yield items
+            pending.extend(reversed(subdirs))
+
+    def _walk_threaded(self):
+        dirs = Queue.Queue()
+        found = Queue.Queue(_walk_backlog)
+        # directories queued or being scanned, the walk is over at 0
+        state = {'outstanding': 1}
+
+        def scanner():
+            while True:
+                dirname = dirs.get()
+                if dirname is None:
+                    return
+                try:
+                    items, subdirs = self.scan(dirname)
+                except:
+                    found.put((None, sys.exc_info()))
+                    return
+                with self._lock:
+                    state['outstanding'] = state['outstanding'] + len(subdirs)
+                for subdir in subdirs:
+                    dirs.put(subdir)
+                if items:
+                    found.put((items, None))
+                with self._lock:
+                    state['outstanding'] = state['outstanding'] - 1
+                    over = state['outstanding'] == 0
+                if over:
+                    for i in xrange(self.threads):
+                        dirs.put(None)
+                    found.put((_done, None))
+
+        dirs.put(self.source)
+        for i in xrange(self.threads):
+            thread = threading.Thread(target=scanner)
+            thread.daemon = True
+            thread.start()
+        while True:
+            items, exc_info = found.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if items is _done:
+                break
+            yield items
+
+    def total(self):
+        """Return the number of files found so far, with a trailing + while
+        the walk is still running"""
+        if self.finished:
+            return str(self.found)
+        return str(self.found) + "+"
+
+
+def bounded(iterable, maxsize, name=None, queues=None):
+    """Run iterable in a background thread and yield its items.
+
+    At most maxsize items are buffered between the thread and the consumer,
+    so a fast producer blocks instead of piling items up in memory.
+    Exceptions raised by the producer are re-raised in the consumer.
+    If queues is given, the buffer is put in it under name, so its depth
+    can be watched.
+    """
+    queue = Queue.Queue(maxsize)
+    if queues is not None:
+        queues[name] = queue
+
+    def feed():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except:
+            queue.put((None, sys.exc_info()))
+        queue.put((_done, None))
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    while True:
+        item, exc_info = queue.get()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is _done:
+            break
+        yield item
+
+
+def _apply_chunk(func, chunk):
+    """Apply func to every item of chunk. Runs in the pool workers."""
+    return [func(item) for item in chunk]
+
+
+def _chunks(iterable, chunksize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ordered_imap(pool, func, iterable, window, chunksize=1):
+    """Like pool.imap, but lazy.
+
+    pool.imap reads its whole input up front, which defeats streaming. This
+    keeps at most window chunks of chunksize items in flight and yields
+    results in input order.
+    """
+    pending = collections.deque()
+    for chunk in _chunks(iterable, chunksize):
+        pending.append(pool.apply_async(_apply_chunk, (func, chunk)))
+        if len(pending) >= window:
+            for result in pending.popleft().get():
+                yield result
+    while pending:
+        for result in pending.popleft().get():
+            yield result
+
+
+class Chunk(object):
+    """Items to call func on together in pool, added with add() and started
+    with submit(). Without a pool submit() does the calls straight away."""
+
+    def __init__(self, pool, func):
+        self.pool = pool
+        self.func = func
+        self.items = []
+        self.submitted = False
+        self.pending = None
+        self.results = None
+
+    def add(self, item):
+        """Add item, returns its index for result()"""
+        self.items.append(item)
+        return len(self.items) - 1
+
+    def submit(self):
+        self.submitted = True
+        if self.pool is None:
+            self.results = _apply_chunk(self.func, self.items)
+        else:
+            self.pending = self.pool.apply_async(_apply_chunk,
+                                                 (self.func, self.items))
+
+    def ready(self):
+        return self.results is not None or (self.pending is not None and
+                                            self.pending.ready())
+
+    def result(self, index):
+        """Return the result of item index, waiting for it if need be"""
+        if self.results is None:
+            self.results = self.pending.get()
+        return self.results[index]
+
+
+class Window(object):
+    """Runs calls in pool with at most size of them in flight.
+
+    submit() and drain() return the (context, result) of the calls that
+    finished, in the order they were submitted, so whatever has to happen
+    after a call, like bookkeeping that is not thread safe, can be done by
+    the submitting thread. Without a pool calls run straight away.
+    """
+
+    def __init__(self, pool=None, size=1):
+        self.pool = pool
+        self.size = size
+        self.pending = collections.deque()
+
+    def submit(self, func, args, context=None):
+        if self.pool is None:
+            return [(context, func(*args))]
+        self.pending.append((context, self.pool.apply_async(func, args)))
+        finished = []
+        while len(self.pending) > self.size:
+            finished.append(self._finish())
+        return finished
+
+    def _finish(self):
+        context, result = self.pending.popleft()
+        return context, result.get()
+
+    def drain(self):
+        """Wait for every call in flight"""
+        return [self._finish() for i in xrange(len(self.pending))]
+
+
+class Delayed(object):
+    """Calls func after sleeping latency seconds, to try things out against
+    a local directory as if it was on slow storage"""
+
+    def __init__(self, func, latency):
+        self.func = func
+        self.latency = latency
+
+    def __call__(self, *args):
+        time.sleep(self.latency)
+        return self.func(*args)
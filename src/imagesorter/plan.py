@@ -0,0 +1,102 @@
+'''
+Sort plans, for imagesorter plan and imagesorter apply.
+
+A plan is what a run would do, written down instead of done: for every
+file the directory it goes to, relative to the target, and its size.
+Sources are relative to the source directory as well, so a plan made on
+one machine can be applied on another that mounts the source and target
+somewhere else.
+
+The file is JSON lines. The first line describes the plan
+
+    {"version": 2, "source": "/photos", "target": "/sorted",
+     "format": "yyyy/mmmm/yyyy_mm_dd", "created": 1381400000.0}
+
+and every line after it is one file, as [kind, source, directory, size]
+
+    ["file", "2013/IMG_0001.JPG", "2013/October/2013_10_10", 2345678]
+
+where kind is file, thm for the sidecar of the file before it, or problem
+for a file without a create date, which goes under exif_problems in the
+directory it is in under the source. Applying the plan puts that under the
+absolute path of the source too, as a run without a plan does.
+
+Paths are byte strings that need not be UTF-8, so they are written as
+latin-1, which maps every byte to a character and back.
+'''
+import os
+import json
+import time
+
+
+version = 2
+kinds = ('file', 'thm', 'problem')
+# how paths are turned into JSON strings and back, losslessly
+_path_encoding = 'latin-1'
+
+
+class PlanError(Exception):
+    """The plan file can not be used"""
+
+
+class PlanWriter(object):
+    """Writes a plan for sorting source into target"""
+
+    def __init__(self, filename, source, target, format):
+        self.source = os.path.abspath(source)
+        self.f = open(filename, 'w')
+        self.files = 0
+        self.bytes = 0
+        self.f.write(json.dumps({'version': version, 'source': self.source,
+                                 'target': target and os.path.abspath(target) or None,
+                                 'format': format,
+                                 'created': time.time()},
+                                encoding=_path_encoding) + '\n')
+
+    def add(self, kind, path, destdir, size):
+        """Plan to put path, of size bytes, in destdir under the target"""
+        src = os.path.relpath(os.path.abspath(path), self.source)
+        self.f.write(json.dumps([kind, src, destdir, size],
+                                encoding=_path_encoding) + '\n')
+        self.files = self.files + 1
+        self.bytes = self.bytes + size
+
+    def close(self):
+        self.f.close()
+
+
+def read(filename):
+    """Return (header, entries) of the plan in filename. entries is a list
+    of (kind, source, directory, size), relative to the source and target
+    of the plan."""
+    with open(filename, 'r') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            raise PlanError(filename + " is not a plan")
+        if not isinstance(header, dict) or header.get('version') != version:
+            raise PlanError(filename + " is not a plan of version " +
+                            str(version))
+        for key in ('source', 'target', 'format'):
+            if header.get(key) is None:
+                continue
+            if not isinstance(header[key], unicode):
+                raise PlanError(filename + " has a broken " + key)
+            header[key] = header[key].encode(_path_encoding)
+        entries = []
+        for number, line in enumerate(f):
+            try:
+                kind, src, destdir, size = json.loads(line)
+            except ValueError:
+                raise PlanError("line " + str(number + 2) + " of " +
+                                filename + " is broken")
+            if kind not in kinds:
+                raise PlanError("line " + str(number + 2) + " of " +
+                                filename + " has unknown kind " + repr(kind))
+            if not (isinstance(src, unicode) and isinstance(destdir, unicode)
+                    and isinstance(size, (int, long))):
+                raise PlanError("line " + str(number + 2) + " of " +
+                                filename + " is broken")
+            entries.append((kind, src.encode(_path_encoding),
+                            destdir.encode(_path_encoding), size))
+    return header, entries
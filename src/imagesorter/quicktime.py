@@ -0,0 +1,169 @@
+r'''
+Create dates of QuickTime and MP4 files, without hachoir.
+
+Both are a sequence of boxes (atoms): a 32 bit size, a four letter type
+and the data, where the data of some boxes is more boxes. The date is in
+the moov box, which cameras often write after the media data, so the top
+level is walked by seeking from box header to box header, and only the
+few small boxes of moov that can hold a date are read:
+
+    moov/mvhd               creation time in seconds since 1904, UTC
+    moov/meta               keys and ilst with com.apple.quicktime.
+                            creationdate, local time and time zone, as
+                            written by iPhones
+    moov/udta/\xa9day       date text, as written by some cameras
+    moov/udta/meta/ilst     the same as an iTunes item
+
+The local time of the Apple keys is preferred, as that is what the EXIF
+dates of pictures taken alongside are in. mvhd is what hachoir reports.
+'''
+import struct
+import datetime
+
+
+# where QuickTime counts seconds from
+_mac_epoch = datetime.datetime(1904, 1, 1)
+# largest box of moov that is read in one go
+_max_read = 64 * 1024
+# boxes a file can start with
+top_level = ('ftyp', 'moov', 'mdat', 'wide', 'free', 'skip', 'pnot')
+# item names that hold a creation date
+_date_keys = ('com.apple.quicktime.creationdate', '\xa9day')
+
+
+class Error(Exception):
+    """The file is not a QuickTime or MP4 file this can read"""
+
+
+def _boxes(f, start, end):
+    """Yield (type, data offset, data size) of the boxes from start to end
+    of f, reading only their headers"""
+    pos = start
+    while end is None or pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        offset = pos + 8
+        if size == 1:
+            large = f.read(8)
+            if len(large) < 8:
+                return
+            size = struct.unpack('>Q', large)[0]
+            offset = offset + 8
+        elif size == 0:
+            # the last box, up to the end of the file
+            if end is None:
+                f.seek(0, 2)
+                end = f.tell()
+            size = end - pos
+        if size < offset - pos:
+            raise Error('box ' + repr(kind) + ' of size ' + str(size))
+        yield kind, offset, size - (offset - pos)
+        pos = pos + size
+
+
+def _children(data):
+    """Yield (type, data) of the boxes in data"""
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        if size < 8:
+            return
+        yield kind, data[pos + 8:pos + size]
+        pos = pos + size
+
+
+def _mvhd_date(data):
+    if data[:1] == '\x01':
+        seconds = struct.unpack('>Q', data[4:12])[0]
+    else:
+        seconds = struct.unpack('>I', data[4:8])[0]
+    if not seconds:
+        # never set, cameras without a clock
+        return None
+    try:
+        return _mac_epoch + datetime.timedelta(seconds=seconds)
+    except OverflowError:
+        return None
+
+
+def _parse_date(text):
+    """Return the local time of an ISO 8601 date like
+    2013-10-10T12:30:00+0200, or None"""
+    text = text.strip('\0 ').replace('T', ' ')
+    try:
+        return datetime.datetime.strptime(text[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def _meta_dates(data):
+    """Yield the dates of the items of a meta box"""
+    if data[:4] == '\0\0\0\0':
+        # the ISO flavour is a full box, with version and flags
+        data = data[4:]
+    keys = {}
+    items = []
+    for kind, child in _children(data):
+        if kind == 'keys' and len(child) >= 8:
+            count = struct.unpack('>I', child[4:8])[0]
+            pos = 8
+            for index in xrange(1, count + 1):
+                if pos + 8 > len(child):
+                    break
+                size = struct.unpack('>I', child[pos:pos + 4])[0]
+                if size < 8:
+                    break
+                keys[struct.pack('>I', index)] = child[pos + 8:pos + size]
+                pos = pos + size
+        elif kind == 'ilst':
+            items = list(_children(child))
+    for kind, item in items:
+        if keys.get(kind, kind) not in _date_keys:
+            continue
+        for data_kind, value in _children(item):
+            if data_kind == 'data':
+                # type and locale come before the value
+                date = _parse_date(value[8:])
+                if date:
+                    yield date
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    return f.read(min(size, _max_read))
+
+
+def read_creation_date(f):
+    """Return the creation date of the QuickTime or MP4 file f, or None if
+    it has none. Raises Error if f is not such a file"""
+    f.seek(0)
+    first = f.read(8)
+    if len(first) < 8 or first[4:8] not in top_level:
+        raise Error('not a QuickTime or MP4 file')
+    for kind, offset, size in _boxes(f, 0, None):
+        if kind != 'moov':
+            continue
+        created = None
+        for child, child_offset, child_size in _boxes(f, offset,
+                                                      offset + size):
+            if child == 'mvhd':
+                created = _mvhd_date(_read(f, child_offset, child_size))
+            elif child == 'meta':
+                for date in _meta_dates(_read(f, child_offset, child_size)):
+                    return date
+            elif child == 'udta':
+                data = _read(f, child_offset, child_size)
+                for item, value in _children(data):
+                    if item == '\xa9day':
+                        # 16 bit length and language before the text
+                        date = _parse_date(value[4:])
+                        if date:
+                            return date
+                    elif item == 'meta':
+                        for date in _meta_dates(value):
+                            return date
+        return created
+    return None
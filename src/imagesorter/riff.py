@@ -0,0 +1,110 @@
+'''
+Create dates of AVI files, without hachoir.
+
+An AVI is a RIFF file: a list of chunks, each a four letter id, a little
+endian 32 bit size and the data, padded to an even length. LIST chunks
+hold more chunks. Cameras put the date in the header list, well before the
+frames:
+
+    LIST hdrl/IDIT          date the file was made, mostly in the ctime
+                            format, Sat Jan 01 08:00:00 2012
+    LIST hdrl/strl/strd     stream data, where some cameras put EXIF like
+                            tags including DateTimeOriginal
+    LIST INFO/ICRD          creation date, often without the time
+
+Top level chunks are walked by seeking from header to header, so LIST
+movi with the frames, nearly all of the file, is never read. INFO/ISFT
+names the camera firmware but carries no date.
+'''
+import re
+import struct
+import datetime
+
+
+# largest header list that is read in one go
+_max_read = 256 * 1024
+_date_formats = ('%a %b %d %H:%M:%S %Y', '%Y:%m:%d %H:%M:%S',
+                 '%Y/%m/%d %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+# an EXIF style date anywhere in a chunk
+_exif_date = re.compile(r'(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)')
+
+
+class Error(Exception):
+    """The file is not a RIFF file this can read"""
+
+
+def _chunks(data):
+    """Yield (id, data) of the chunks in data, and (LIST id, data) for
+    lists"""
+    pos = 0
+    while pos + 8 <= len(data):
+        fourcc, size = struct.unpack('<4sI', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + size]
+        if fourcc == 'LIST':
+            yield 'LIST ' + body[:4], body[4:]
+        else:
+            yield fourcc, body
+        pos = pos + 8 + size + size % 2
+
+
+def _parse_date(text):
+    text = ' '.join(text.strip('\0\r\n ').split())
+    for format in _date_formats:
+        try:
+            return datetime.datetime.strptime(text, format)
+        except ValueError:
+            continue
+    return _search_date(text)
+
+
+def _search_date(data):
+    match = _exif_date.search(data)
+    if match:
+        try:
+            return datetime.datetime(*[int(n) for n in match.groups()])
+        except ValueError:
+            return None
+    return None
+
+
+def _header_dates(data, dates):
+    """Put the first date found in a chunk of each id in data in dates"""
+    for fourcc, body in _chunks(data):
+        if fourcc.startswith('LIST '):
+            _header_dates(body, dates)
+            continue
+        if fourcc in dates:
+            continue
+        if fourcc == 'IDIT' or fourcc == 'ICRD':
+            date = _parse_date(body)
+        elif fourcc == 'strd':
+            date = _search_date(body)
+        else:
+            continue
+        if date:
+            dates[fourcc] = date
+
+
+def read_creation_date(f):
+    """Return the creation date of the AVI file f, or None if it has none.
+    Raises Error if f is not a RIFF file"""
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != 'RIFF':
+        raise Error('not a RIFF file')
+    dates = {}
+    pos = 12
+    while True:
+        f.seek(pos)
+        chunk = f.read(12)
+        if len(chunk) < 8:
+            break
+        fourcc, size = struct.unpack('<4sI', chunk[:8])
+        if fourcc == 'LIST' and chunk[8:12] in ('hdrl', 'INFO'):
+            f.seek(pos + 12)
+            _header_dates(f.read(max(0, min(size - 4, _max_read))), dates)
+        pos = pos + 8 + size + size % 2
+    for fourcc in ('IDIT', 'strd', 'ICRD'):
+        if dates.get(fourcc):
+            return dates[fourcc]
+    return None